@@ -1,30 +1,90 @@
-from datetime import time, UTC
+import asyncio
 import os
-import logging
-from logging.handlers import TimedRotatingFileHandler
+import sys
+from typing import Optional
 
-import discord
 from dotenv import load_dotenv
 
-from stop_playing_factorio.db import connect, create_tables
-from stop_playing_factorio.game_watch_bot import GameWatchBot
+from stop_playing_factorio.db import connections, migrate
+from stop_playing_factorio.game_watch_bot import GameWatchBot, ShardedGameWatchBot
+from stop_playing_factorio.log_pipeline import start_logging
+from stop_playing_factorio.roles import ROLES, NudgeQueueScheduler, NudgeWorker
+
+
+def get_shards_from_env() -> tuple[Optional[int], Optional[list[int]]]:
+    """
+    Reads the shard count and the shards to run in this process from the
+    `SHARD_COUNT` and `SHARD_IDS` (e.g. "0,1") env variables. A `SHARD_COUNT` of
+    "auto" uses the number of shards Discord recommends, which can't be used
+    with `SHARD_IDS`, as every process needs to agree on the count.
+    """
+    shard_count = os.getenv("SHARD_COUNT", "auto")
+    shard_ids = os.getenv("SHARD_IDS")
+    if shard_ids and not shard_count.isdigit():
+        sys.exit(
+            f"SHARD_IDS needs SHARD_COUNT to be set to a number of shards, "
+            f"not {shard_count!r}"
+        )
+    return (
+        None if shard_count == "auto" else int(shard_count),
+        [int(shard_id) for shard_id in shard_ids.split(",")] if shard_ids else None,
+    )
 
 
 def main() -> None:
     load_dotenv()
-    create_tables(connect())
+    # "all" runs everything in this process; see `roles` for the others.
+    role = os.getenv("ROLE", "all")
+    if role not in ROLES:
+        raise ValueError(f"Unknown role: {role}")
+    sharded = bool(os.getenv("SHARD_COUNT") or os.getenv("SHARD_IDS"))
+    shard_count, shard_ids = get_shards_from_env()
+    worker_id = os.getenv("WORKER_ID")
 
-    bot = GameWatchBot(game="Factorio")
+    # Each process needs its own log file.
+    log_name = "spfbot"
+    if role != "all":
+        log_name += f"-{role}"
+    if role == "worker":
+        log_name += f"-{worker_id or os.getpid()}"
+    elif shard_ids:
+        log_name += f"-shard{shard_ids[0]}"
+    log_listener = start_logging(f"logs/{log_name}.log")
+    try:
+        migrate(connections.writer())
+        metrics_port = int(os.getenv("METRICS_PORT", "9108"))
 
-    handler = TimedRotatingFileHandler(
-        filename="logs/spfbot.log",
-        when="midnight",
-        encoding="utf-8",
-        utc=True,
-        atTime=time(6, 00, tzinfo=UTC),
-    )
-    discord.utils.setup_logging(level=logging.INFO, handler=handler)
-    bot.run(os.getenv("DISCORD_TOKEN"))
+        if role == "scheduler":
+            asyncio.run(NudgeQueueScheduler(metrics_port=metrics_port).run())
+            return
+        if role == "worker":
+            worker = NudgeWorker(
+                game="Factorio", worker_id=worker_id, metrics_port=metrics_port
+            )
+            asyncio.run(worker.run_worker(os.getenv("DISCORD_TOKEN")))
+            return
+
+        options = dict(
+            game="Factorio",
+            stream_replies=True,
+            metrics_port=metrics_port,
+            lean_member_cache=os.getenv("LEAN_MEMBER_CACHE") == "1",
+        )
+        if role == "gateway":
+            # Nudges are left to the scheduler and workers, which share the
+            # gateway's conversations.
+            options.update(send_nudges=False, conversation_cache_size=0)
+        if sharded:
+            bot = ShardedGameWatchBot(
+                **options, shard_count=shard_count, shard_ids=shard_ids
+            )
+        else:
+            bot = GameWatchBot(**options)
+        # Logging's already set up, to go through the queue.
+        bot.run(os.getenv("DISCORD_TOKEN"), log_handler=None)
+    finally:
+        # Writes out anything still queued.
+        log_listener.stop()
 
 
 if __name__ == "__main__":
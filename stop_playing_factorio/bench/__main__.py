@@ -0,0 +1,416 @@
+"""
+Drives the bot's event handlers with synthetic guilds, members and messages,
+using fake discord.py objects and the stub LLM backend, and reports handler
+throughput and latency, event loop lag and database writes. The results are
+also written as JSON, so runs can be compared over time.
+
+    python -m stop_playing_factorio.bench [--scenario NAME] [--members N]
+        [--playing FRACTION] [--presence-rate N] [--message-rate N]
+        [--duration SECONDS] [--llm-latency SECONDS] [--output PATH]
+"""
+
+import argparse
+import asyncio
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from typing import Awaitable, Optional
+
+import discord
+import pytz
+
+from stop_playing_factorio.db import connections, migrate
+from stop_playing_factorio.game_watch_bot import GameWatchBot
+
+GAME = "Factorio"
+
+SCENARIOS = {
+    "presence-storm": dict(
+        members=50_000, playing=0.05, presence_rate=200, message_rate=0
+    ),
+    "message-flood": dict(
+        members=5_000, playing=0.05, presence_rate=0, message_rate=50
+    ),
+    "mixed": dict(members=20_000, playing=0.05, presence_rate=100, message_rate=10),
+}
+
+
+@dataclass
+class FakeActivity:
+    name: str
+    created_at: datetime
+    type: discord.ActivityType = discord.ActivityType.playing
+
+
+@dataclass(eq=False)
+class FakeMember:
+    id: int
+    activities: tuple = ()
+
+    @property
+    def name(self) -> str:
+        return f"member{self.id}"
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, members: list[FakeMember]):
+        self.id = guild_id
+        self.members = members
+        self._members = {member.id: member for member in members}
+
+    def get_member(self, discord_id: int) -> Optional[FakeMember]:
+        return self._members.get(discord_id)
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, sent: list[str]):
+        self.sent = sent
+
+    def typing(self) -> FakeTyping:
+        return FakeTyping()
+
+    async def send(self, content: str):
+        self.sent.append(content)
+
+
+@dataclass(eq=False)
+class FakeMessage:
+    content: str
+    author: FakeMember
+    channel: FakeChannel
+
+    async def reply(self, content: str) -> "FakeMessage":
+        await self.channel.send(content)
+        return self
+
+    async def edit(self, content: str) -> "FakeMessage":
+        return self
+
+    async def add_reaction(self, emoji: str):
+        pass
+
+
+@dataclass(eq=False)
+class FakeUser:
+    id: int
+    dm_channel: FakeChannel
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+
+class BenchBot(GameWatchBot):
+    """
+    The bot, with the parts that would talk to Discord replaced.
+    """
+
+    def __init__(self, guilds: list[FakeGuild], *args, **kwargs):
+        super().__init__(GAME, *args, **kwargs)
+        self.fake_guilds = guilds
+        self.sent: list[str] = []
+        self.bench_user = FakeUser(0, FakeChannel(self.sent))
+
+    @property
+    def user(self):
+        return self.bench_user
+
+    @property
+    def guilds(self):
+        return self.fake_guilds
+
+    def get_user(self, discord_id: int) -> FakeUser:
+        return FakeUser(discord_id, FakeChannel(self.sent))
+
+
+@dataclass
+class Timings:
+    samples: dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+
+    async def time(self, name: str, handler: Awaitable):
+        started = time.perf_counter()
+        try:
+            await handler
+        finally:
+            self.samples[name].append(time.perf_counter() - started)
+
+
+def percentile(samples: list[float], percentile: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+def summarise(samples: list[float], duration: float) -> dict:
+    return {
+        "count": len(samples),
+        "per_second": len(samples) / duration,
+        "p50_ms": (percentile(samples, 50) or 0) * 1000,
+        "p99_ms": (percentile(samples, 99) or 0) * 1000,
+        "max_ms": max(samples, default=0) * 1000,
+    }
+
+
+def midday_time_zone() -> str:
+    """
+    A time zone where it's currently around midday, so that lateness nudges
+    don't depend on when the benchmark is run.
+    """
+    offset = (12 - datetime.now(pytz.utc).hour + 12) % 24 - 12
+    # The Etc/GMT zones' signs are the opposite of their UTC offsets.
+    return f"Etc/GMT{-offset:+d}" if offset else "Etc/GMT"
+
+
+def create_guilds(
+    rng: random.Random, members: int, playing: float, duration: float
+) -> list[FakeGuild]:
+    """
+    Creates the members in guilds of up to 10k. Members who are playing
+    started an hour ago, give or take the length of the run, so that some of
+    their first nudges fall due during it.
+    """
+    now = datetime.now(pytz.utc)
+    all_members = []
+    for discord_id in range(1, members + 1):
+        member = FakeMember(discord_id)
+        if rng.random() < playing:
+            started_at = (
+                now
+                - timedelta(hours=1)
+                + timedelta(seconds=rng.uniform(-duration, duration))
+            )
+            member.activities = (FakeActivity(GAME, started_at),)
+        all_members.append(member)
+    return [
+        FakeGuild(guild_id, all_members[start : start + 10_000])
+        for guild_id, start in enumerate(range(0, members, 10_000), 1)
+    ]
+
+
+async def generate(rate: float, duration: float, event):
+    """
+    Calls `event` `rate` times a second for `duration` seconds.
+    """
+    if not rate:
+        return
+    started = time.perf_counter()
+    sent = 0
+    while (elapsed := time.perf_counter() - started) < duration:
+        while sent < elapsed * rate:
+            event()
+            sent += 1
+        await asyncio.sleep(0.005)
+
+
+async def monitor_loop_lag(samples: list[float], interval: float = 0.05):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    guilds = create_guilds(rng, args.members, args.playing, args.duration)
+    members = [member for guild in guilds for member in guild.members]
+
+    con = connections.writer()
+    con.execute("BEGIN")
+    con.executemany(
+        "INSERT INTO UserStates(discord_id, time_zone) VALUES (?, ?);",
+        [(member.id, midday_time_zone()) for member in members],
+    )
+    con.execute("COMMIT")
+
+    bot = BenchBot(guilds, presence_debounce_seconds=args.debounce)
+    bot.db_writer.start()
+    timings = Timings()
+    tasks = set()
+
+    def spawn(name: str, handler: Awaitable):
+        task = asyncio.create_task(timings.time(name, handler))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    def presence_update():
+        member = rng.choice(members)
+        before = FakeMember(member.id, member.activities)
+        if rng.random() < 0.5:
+            # Most presence updates don't change whether a member's playing,
+            # e.g. a status change or a rich presence update.
+            pass
+        elif member.activities:
+            member.activities = ()
+        elif rng.random() < args.playing / (1 - args.playing):
+            member.activities = (FakeActivity(GAME, datetime.now(pytz.utc)),)
+        spawn("on_presence_update", bot.on_presence_update(before, member))
+
+    def message():
+        member = rng.choice(members)
+        spawn(
+            "on_message",
+            bot.on_message(
+                FakeMessage("Why should I stop?", member, FakeChannel(bot.sent))
+            ),
+        )
+
+    async def nudge_loop():
+        while True:
+            await bot.nudge_scheduler.wait_until_due()
+            await timings.time("check_for_nudges_due", bot.check_for_nudges_due())
+
+    async def pregenerate_loop():
+        while True:
+            await timings.time("pregenerate_nudges", bot.pregenerate_nudges.coro(bot))
+            await asyncio.sleep(60)
+
+    for guild in guilds:
+        await timings.time("on_guild_available", bot.on_guild_available(guild))
+    await timings.time("sync_data", bot.sync_data.coro(bot))
+    await bot.db_writer.flush()
+    writes_before, batches_before = bot.db_writer.writes, bot.db_writer.batches
+
+    loop_lag = []
+    background = [
+        asyncio.create_task(monitor_loop_lag(loop_lag)),
+        asyncio.create_task(nudge_loop()),
+        asyncio.create_task(pregenerate_loop()),
+    ]
+    started = time.perf_counter()
+    await asyncio.gather(
+        generate(args.presence_rate, args.duration, presence_update),
+        generate(args.message_rate, args.duration, message),
+    )
+    if tasks:
+        await asyncio.wait(set(tasks))
+    elapsed = time.perf_counter() - started
+    await bot.db_writer.flush()
+    writes = bot.db_writer.writes - writes_before
+    batches = bot.db_writer.batches - batches_before
+
+    await timings.time("sync_data", bot.sync_data.coro(bot))
+    for task in background:
+        task.cancel()
+    for task in list(bot.nudges_in_flight.values()):
+        task.cancel()
+    for *_, pending in bot.presence_coalescer._pending.values():
+        pending.cancel()
+    await bot.db_writer.close()
+
+    return {
+        "scenario": args.scenario,
+        "parameters": {
+            name: getattr(args, name)
+            for name in (
+                "members",
+                "playing",
+                "presence_rate",
+                "message_rate",
+                "duration",
+                "llm_latency",
+                "debounce",
+                "seed",
+            )
+        },
+        "run_at": datetime.now(pytz.utc).isoformat(),
+        "commit": git_commit(),
+        "elapsed_seconds": elapsed,
+        "handlers": {
+            name: summarise(samples, elapsed)
+            for name, samples in timings.samples.items()
+        },
+        "loop_lag": summarise(loop_lag, elapsed),
+        "db": {
+            "writes": writes,
+            "batches": batches,
+            "writes_per_second": writes / elapsed,
+        },
+        "presence": dict(bot.presence_coalescer.counters),
+        "nudges": {"sent": len(bot.nudge_lag.samples), "lag": str(bot.nudge_lag)},
+        "messages_sent": len(bot.sent),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: dict):
+    print(f"{results['scenario']}: {results['parameters']}")
+    print(f"{'':<24}{'count':>8}{'per sec':>10}{'p50 (ms)':>10}{'p99 (ms)':>10}")
+    for name, summary in [
+        *results["handlers"].items(),
+        ("loop lag", results["loop_lag"]),
+    ]:
+        print(
+            f"{name:<24}{summary['count']:>8}{summary['per_second']:>10.1f}"
+            f"{summary['p50_ms']:>10.2f}{summary['p99_ms']:>10.2f}"
+        )
+    db = results["db"]
+    print(f"DB: {db['writes']} writes in {db['batches']} batches")
+    print(f"Presence updates: {results['presence']}")
+    print(f"Nudges: {results['nudges']['sent']} sent ({results['nudges']['lag']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", choices=SCENARIOS, default="presence-storm")
+    parser.add_argument("--members", type=int)
+    parser.add_argument("--playing", type=float)
+    parser.add_argument("--presence-rate", type=float)
+    parser.add_argument("--message-rate", type=float)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--debounce", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="defaults to bench-SCENARIO.json")
+    args = parser.parse_args()
+    for name, value in SCENARIOS[args.scenario].items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+
+    os.environ["LLM_BACKEND"] = "stub"
+    os.environ["STUB_LLM_LATENCY"] = str(args.llm_latency)
+
+    with tempfile.TemporaryDirectory() as directory:
+        connections.path = os.path.join(directory, "bench.db")
+        migrate(connections.writer())
+        results = asyncio.run(run(args))
+        connections.close()
+
+    print_results(results)
+    output = args.output or f"bench-{args.scenario}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Compares the per-event database overhead of opening a connection in every
+handler with using the shared connection manager and background writer.
+
+    python -m stop_playing_factorio.bench.connections [--events N]
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+from stop_playing_factorio.db import ConnectionManager, connections, migrate
+from stop_playing_factorio.db.game_sessions import (
+    is_in_game_session,
+    start_game_session,
+)
+from stop_playing_factorio.db.writer import DatabaseWriter
+
+
+def connect_per_event(path: str) -> sqlite3.Connection:
+    # How every handler used to connect.
+    return sqlite3.connect(
+        path, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None
+    )
+
+
+def bench_connect_per_event(path: str, events: int) -> tuple[float, float]:
+    started = time.perf_counter()
+    for discord_id in range(events):
+        is_in_game_session(connect_per_event(path), discord_id)
+    read = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for discord_id in range(events):
+        start_game_session(connect_per_event(path), discord_id, None)
+    write = time.perf_counter() - started
+    return read, write
+
+
+async def bench_connection_manager(
+    manager: ConnectionManager, events: int
+) -> tuple[float, float]:
+    started = time.perf_counter()
+    for discord_id in range(events):
+        with manager.reader() as con:
+            is_in_game_session(con, discord_id)
+    read = time.perf_counter() - started
+
+    writer = DatabaseWriter()
+    writer.start()
+    started = time.perf_counter()
+    for discord_id in range(events, 2 * events):
+        await writer.submit(start_game_session, discord_id, None)
+    await writer.close()
+    write = time.perf_counter() - started
+    return read, write
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        connections.path = os.path.join(directory, "bench.db")
+        migrate(connections.writer())
+
+        results = {
+            "connect() per event": bench_connect_per_event(
+                connections.path, args.events
+            ),
+            "connection manager": asyncio.run(
+                bench_connection_manager(connections, args.events)
+            ),
+        }
+        connections.close()
+
+    print(f"{'':<22}{'read (µs/event)':>18}{'write (µs/event)':>18}")
+    for name, (read, write) in results.items():
+        print(
+            f"{name:<22}"
+            f"{read / args.events * 1e6:>18.1f}"
+            f"{write / args.events * 1e6:>18.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Compares the bot's memory use with discord.py's default member cache against
+the lean member cache, reporting the RSS used per 10k guild members. Each mode
+runs in its own process, which feeds synthetic GUILD_CREATE payloads (with
+members and presences, as chunking would give, or just presences, as the lean
+mode gets) through discord.py's parser.
+
+    python -m stop_playing_factorio.bench.memory [--members N] [--online FRACTION]
+        [--playing FRACTION]
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from stop_playing_factorio.game_watch_bot import GameWatchBot
+
+GAME = "Factorio"
+OTHER_GAMES = ["Satisfactory", "Dyson Sphere Program", "Shapez", "Minecraft"]
+GUILD_SIZE = 10_000
+MODES = ("default", "lean")
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Peak rather than current, in KiB on Linux (and bytes on macOS).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def activity(rng: random.Random, playing: float) -> dict:
+    now_ms = int(time.time() * 1000)
+    started_ms = now_ms - rng.randint(0, 4 * 60 * 60 * 1000)
+    roll = rng.random()
+    if roll < playing:
+        name = GAME
+    elif roll < 0.5:
+        name = rng.choice(OTHER_GAMES)
+    else:
+        return {
+            "name": "Custom Status",
+            "type": 4,
+            "state": "Building the factory",
+            "created_at": now_ms,
+        }
+    return {
+        "name": name,
+        "type": 0,
+        "created_at": started_ms,
+        "timestamps": {"start": started_ms},
+        "application_id": str(rng.getrandbits(60)),
+    }
+
+
+def guild_create(
+    rng: random.Random,
+    guild_id: int,
+    member_ids: range,
+    online: float,
+    playing: float,
+    with_members: bool,
+) -> dict:
+    """
+    A GUILD_CREATE payload. Without the members intent, Discord doesn't send
+    the members, but still sends the online members' presences.
+    """
+    members = []
+    presences = []
+    for discord_id in member_ids:
+        if with_members:
+            members.append(
+                {
+                    "user": {
+                        "id": str(discord_id),
+                        "username": f"member{discord_id}",
+                        "global_name": f"Member {discord_id}",
+                        "discriminator": "0",
+                        "avatar": f"{discord_id:032x}",
+                        "public_flags": 0,
+                    },
+                    # Not random, so that both modes get the same presences.
+                    "roles": [str(role_id) for role_id in range(discord_id % 4)],
+                    "joined_at": "2024-01-01T00:00:00+00:00",
+                    "nick": None,
+                    "avatar": None,
+                    "premium_since": None,
+                    "pending": False,
+                    "flags": 0,
+                    "deaf": False,
+                    "mute": False,
+                }
+            )
+        if rng.random() < online:
+            presences.append(
+                {
+                    "user": {"id": str(discord_id)},
+                    "status": "online",
+                    "client_status": {"desktop": "online"},
+                    "activities": [activity(rng, playing / online)],
+                }
+            )
+    return {
+        "id": str(guild_id),
+        "name": f"Guild {guild_id}",
+        "member_count": len(member_ids),
+        "large": True,
+        "channels": [],
+        "roles": [],
+        "members": members,
+        "presences": presences,
+    }
+
+
+async def measure(mode: str, members: int, online: float, playing: float, seed: int):
+    rng = random.Random(seed)
+    # Long enough that no game sessions are started during the run.
+    bot = GameWatchBot(
+        GAME, lean_member_cache=mode == "lean", presence_debounce_seconds=600
+    )
+    async with bot:
+        parse_guild_create = bot._connection.parsers["GUILD_CREATE"]
+        gc.collect()
+        baseline = rss_bytes()
+
+        for guild_id, start in enumerate(range(0, members, GUILD_SIZE), 1):
+            member_ids = range(start + 1, min(start + GUILD_SIZE, members) + 1)
+            parse_guild_create(
+                guild_create(
+                    rng, guild_id, member_ids, online, playing, mode == "default"
+                )
+            )
+            # Lets the guild's handlers run.
+            await asyncio.sleep(0.2)
+
+        gc.collect()
+        used = rss_bytes() - baseline
+    return {
+        "mode": mode,
+        "members": members,
+        "cached_members": sum(len(guild.members) for guild in bot.guilds),
+        "playing_members": len(bot.playing_members),
+        "rss_bytes": used,
+        "rss_bytes_per_10k_members": used * 10_000 / members,
+    }
+
+
+def run_child(mode: str, args: argparse.Namespace) -> dict:
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "stop_playing_factorio.bench.memory",
+            "--child",
+            mode,
+            "--members",
+            str(args.members),
+            "--online",
+            str(args.online),
+            "--playing",
+            str(args.playing),
+            "--seed",
+            str(args.seed),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--members", type=int, default=50_000)
+    parser.add_argument("--online", type=float, default=0.3)
+    parser.add_argument("--playing", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        results = asyncio.run(
+            measure(args.child, args.members, args.online, args.playing, args.seed)
+        )
+        print(json.dumps(results))
+        return
+
+    print(
+        f"{args.members} members, {args.online:.0%} online, "
+        f"{args.playing:.0%} playing {GAME}"
+    )
+    print(f"{'':<10}{'cached':>10}{'playing':>10}{'RSS (MB)':>12}{'MB / 10k':>12}")
+    for mode in MODES:
+        results = run_child(mode, args)
+        print(
+            f"{mode:<10}{results['cached_members']:>10}"
+            f"{results['playing_members']:>10}"
+            f"{results['rss_bytes'] / 2**20:>12.1f}"
+            f"{results['rss_bytes_per_10k_members'] / 2**20:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compares the single-pass `Sanitiser` against the previous implementation
+(copied below), sanitising a request's instructions and conversation history
+and desanitising the response. That they give identical output is checked by
+`tests/test_sanitise.py`.
+
+    python -m stop_playing_factorio.bench.sanitise [--messages N] [--users N]
+"""
+
+import argparse
+import random
+import re
+import time
+from typing import Iterable, Union
+
+from stop_playing_factorio.llm import CORE_CONTEXT, SESSION_CONTEXT
+from stop_playing_factorio.llm.sanitise import Sanitiser, hash
+
+WORDS = "belt inserter smelter train biter rocket gear circuit spaghetti bus".split()
+
+
+def legacy_get_user_ids_map(msgs: Iterable[str]) -> dict[str, str]:
+    user_ids = set()
+    for msg in msgs:
+        user_ids.update(re.findall(r"<@(\d+)>", msg))
+    return {f"<@{id}>": f"<@{hash(id)}>" for id in list(user_ids)}
+
+
+def legacy_sanitise(
+    input_: Union[str, dict, tuple], str_map: dict[str, str], reversed=False
+) -> str:
+    if reversed:
+        str_map = {v: k for k, v in str_map.items()}
+
+    if type(input_) == str:
+        for key, value in str_map.items():
+            input_ = input_.replace(key, value)
+        return input_
+    if type(input_) == dict:
+        sanitised = {}
+        for k, v in input_.items():
+            sanitised[k] = legacy_sanitise(v, str_map)
+        return sanitised
+    if type(input_) == tuple:
+        return tuple(legacy_sanitise(x, str_map) for x in input_)
+    if type(input_) == list:
+        return list(legacy_sanitise(x, str_map) for x in input_)
+    return input_
+
+
+def legacy(instructions: str, messages: list[dict], output: str):
+    user_ids_map = legacy_get_user_ids_map(
+        [instructions] + [msg["content"] for msg in messages]
+    )
+    instructions, messages = legacy_sanitise((instructions, messages), user_ids_map)
+    return instructions, messages, legacy_sanitise(output, user_ids_map, reversed=True)
+
+
+def single_pass(instructions: str, messages: list[dict], output: str):
+    sanitiser = Sanitiser()
+    instructions = sanitiser.sanitise(instructions)
+    messages = sanitiser.sanitise_messages(messages)
+    return instructions, messages, sanitiser.desanitise(output)
+
+
+def random_text(rng: random.Random, user_ids: list[int]) -> str:
+    return " ".join(
+        f"<@{rng.choice(user_ids)}>" if rng.random() < 0.1 else rng.choice(WORDS)
+        for _ in range(rng.randint(5, 40))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    user_ids = [rng.randrange(10**17, 10**19) for _ in range(args.users)]
+    instructions = CORE_CONTEXT + SESSION_CONTEXT.format(
+        bot_handle=f"<@{user_ids[0]}>",
+        user_context=f"The player's handle is <@{user_ids[1 % args.users]}>. ",
+    )
+    messages = [
+        {
+            "role": rng.choice(["user", "assistant"]),
+            "content": random_text(rng, user_ids),
+        }
+        for _ in range(args.messages)
+    ]
+    # The LLM's response mentions the sanitised IDs.
+    output = Sanitiser().sanitise(random_text(rng, user_ids))
+
+    print(f"{args.requests} requests, {args.messages} messages, {args.users} users")
+    timings = {}
+    for name, fn in (("legacy", legacy), ("single-pass", single_pass)):
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            fn(instructions, messages, output)
+        timings[name] = (time.perf_counter() - started) / args.requests
+        print(f"{name:>12}: {timings[name] * 1e6:8.1f}us per request")
+    print(f"{'speedup':>12}: {timings['legacy'] / timings['single-pass']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
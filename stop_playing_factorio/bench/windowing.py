@@ -0,0 +1,75 @@
+"""
+Compares the size of LLM requests for a long conversation with and without
+the token-budgeted context window. With `--live`, the final turn is also sent
+to the OpenAI API both ways to compare latency.
+
+    python -m stop_playing_factorio.bench.windowing [--turns N] [--live]
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from stop_playing_factorio.db.conversations import Conversation
+from stop_playing_factorio.llm import CORE_CONTEXT, SESSION_CONTEXT, create_response
+from stop_playing_factorio.llm.context import (
+    count_message_tokens,
+    count_tokens,
+    get_context_window,
+)
+
+WORDS = "belt inserter smelter train biter rocket gear circuit spaghetti bus".split()
+
+INSTRUCTIONS = CORE_CONTEXT + SESSION_CONTEXT.format(
+    bot_handle="<@1>", user_context="The player's handle is <@2>. "
+)
+
+
+def random_message(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+async def fake_summarise(summary, messages) -> str:
+    # Summaries are asked to be a few sentences long.
+    return random_message(random.Random(len(messages)), 60)
+
+
+async def run(turns: int, live: bool):
+    rng = random.Random(0)
+    conversation = Conversation(0, [])
+    print(f"{'turn':>6}{'full (tokens)':>16}{'windowed (tokens)':>20}")
+    for turn in range(1, turns + 1):
+        conversation.add_user_message(random_message(rng, rng.randint(5, 40)))
+        full = conversation.llm_message_history
+        windowed = await get_context_window(conversation, fake_summarise)
+        conversation.add_assistant_message(random_message(rng, rng.randint(10, 40)))
+        if turn % max(1, turns // 10) == 0:
+            instructions_tokens = count_tokens(INSTRUCTIONS)
+            print(
+                f"{turn:>6}"
+                f"{instructions_tokens + count_message_tokens(full):>16}"
+                f"{instructions_tokens + count_message_tokens(windowed):>20}"
+            )
+
+    if live:
+        conversation.add_user_message(random_message(rng, 20))
+        for name, messages in (
+            ("full", conversation.llm_message_history),
+            ("windowed", await get_context_window(conversation, fake_summarise)),
+        ):
+            started = time.perf_counter()
+            await create_response(INSTRUCTIONS, messages)
+            print(f"{name} request latency: {time.perf_counter() - started:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--live", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(run(args.turns, args.live))
+
+
+if __name__ == "__main__":
+    main()
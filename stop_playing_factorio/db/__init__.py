@@ -1,5 +1,16 @@
+from contextlib import contextmanager
 from datetime import UTC, datetime
+import logging
+import queue
 import sqlite3
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+logger = logging.getLogger()
+
+DATABASE_PATH = "spfbot.db"
+STATEMENT_CACHE_SIZE = 256
 
 
 def adapt_datetime_iso(val: datetime) -> str:
@@ -16,10 +27,156 @@ sqlite3.register_adapter(datetime, adapt_datetime_iso)
 sqlite3.register_converter("DATETIME", convert_datetime)
 
 
-def connect() -> sqlite3.Connection:
-    return sqlite3.connect(
-        "spfbot.db", detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None
+def connect(path: str = DATABASE_PATH, read_only: bool = False) -> sqlite3.Connection:
+    con = sqlite3.connect(
+        f"file:{path}{'?mode=ro' if read_only else ''}",
+        uri=True,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        isolation_level=None,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        # Connections are handed between threads by the connection manager,
+        # which makes sure only one thread uses each at a time.
+        check_same_thread=False,
     )
+    if not read_only:
+        # WAL lets readers carry on while the writer commits. NORMAL sync is
+        # safe in WAL mode (a power cut can only lose the latest commits), and
+        # saves an fsync per transaction on the Pi's SD card.
+        con.execute("PRAGMA journal_mode = WAL;")
+        con.execute("PRAGMA synchronous = NORMAL;")
+    con.execute("PRAGMA busy_timeout = 5000;")
+    # 8MB page cache (negative values are in KiB) and 64MB memory-mapped I/O.
+    con.execute("PRAGMA cache_size = -8000;")
+    con.execute("PRAGMA mmap_size = 67108864;")
+    return con
+
+
+class ConnectionManager:
+    """
+    Holds the process's database connections, so that they (and SQLite's
+    cache of prepared statements on each one) are reused rather than reopened
+    by every event handler.
+
+    There's one writer connection, which belongs to the `DatabaseWriter`
+    thread (and to migrations before that starts), and a small pool of
+    read-only connections. Connections that haven't been used for
+    `health_check_interval` seconds are checked before they're handed out, and
+    reopened if they've broken.
+    """
+
+    def __init__(
+        self,
+        path: str = DATABASE_PATH,
+        pool_size: int = 4,
+        health_check_interval: float = 60.0,
+    ):
+        self.path = path
+        self.pool_size = pool_size
+        self.health_check_interval = health_check_interval
+        self._writer: Optional[sqlite3.Connection] = None
+        self._idle_readers: queue.LifoQueue = queue.LifoQueue()
+        self._reader_count = 0
+        self._last_used: dict[sqlite3.Connection, float] = {}
+        self._lock = threading.Lock()
+
+    def writer(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._writer is None:
+                self._writer = self._open()
+            self._writer = self._checked(self._writer)
+            return self._writer
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrows a read-only connection from the pool. If every pooled
+        connection is in use, a temporary one is opened rather than waiting
+        (which could block the event loop).
+        """
+        try:
+            con = self._idle_readers.get_nowait()
+        except queue.Empty:
+            con = None
+
+        if con is not None:
+            pooled = True
+            con = self._checked(con, read_only=True)
+        else:
+            with self._lock:
+                pooled = self._reader_count < self.pool_size
+                if pooled:
+                    self._reader_count += 1
+            con = self._open(read_only=True)
+
+        try:
+            yield con
+        finally:
+            if pooled:
+                self._last_used[con] = time.monotonic()
+                self._idle_readers.put(con)
+            else:
+                del self._last_used[con]
+                con.close()
+
+    def close(self):
+        with self._lock:
+            while not self._idle_readers.empty():
+                self._idle_readers.get_nowait().close()
+            if self._writer is not None:
+                self._writer.close()
+            self._writer = None
+            self._reader_count = 0
+            self._last_used = {}
+
+    def _open(self, read_only: bool = False) -> sqlite3.Connection:
+        con = connect(self.path, read_only=read_only)
+        self._last_used[con] = time.monotonic()
+        return con
+
+    def _checked(
+        self, con: sqlite3.Connection, read_only: bool = False
+    ) -> sqlite3.Connection:
+        """
+        Returns the connection if it's healthy, or a new one to replace it.
+        """
+        if time.monotonic() - self._last_used[con] < self.health_check_interval:
+            return con
+        try:
+            con.execute("SELECT 1;").fetchone()
+            self._last_used[con] = time.monotonic()
+            return con
+        except sqlite3.Error:
+            logger.warning("Reopening broken database connection", exc_info=True)
+            del self._last_used[con]
+            con.close()
+            return self._open(read_only=read_only)
+
+
+connections = ConnectionManager()
+
+
+def migrate(con: sqlite3.Connection):
+    """
+    Brings the database schema up-to-date. The schema version is stored in
+    SQLite's `user_version`, and each migration that hasn't been applied yet is
+    run in its own transaction.
+    """
+    while True:
+        # The version is read inside the write transaction, so that processes
+        # starting at the same time (e.g. shards) don't run a migration twice.
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            (version,) = con.execute("PRAGMA user_version;").fetchone()
+            if version >= len(MIGRATIONS):
+                con.execute("COMMIT")
+                return
+            logger.info(f"Migrating database to version {version + 1}...")
+            MIGRATIONS[version](con)
+            con.execute(f"PRAGMA user_version = {version + 1};")
+            con.execute("COMMIT")
+        except:
+            con.execute("ROLLBACK")
+            raise
 
 
 def create_tables(con: sqlite3.Connection):
@@ -61,3 +218,138 @@ def create_tables(con: sqlite3.Connection):
         );
         """
     )
+
+
+def add_indexes(con: sqlite3.Connection):
+    # The nudge scheduler loads the active, unmuted game sessions.
+    con.execute(
+        """
+        CREATE INDEX IF NOT EXISTS GameSessionsActive
+            ON GameSessions(discord_id)
+            WHERE ended_at IS NULL AND muted = FALSE;
+        """
+    )
+    # The reapers delete ended game sessions and stale conversations.
+    con.execute(
+        """
+        CREATE INDEX IF NOT EXISTS GameSessionsEndedAt
+            ON GameSessions(ended_at)
+            WHERE ended_at IS NOT NULL;
+        """
+    )
+    con.execute(
+        """
+        CREATE INDEX IF NOT EXISTS ConversationsLatestMessage
+            ON Conversations(latest_message);
+        """
+    )
+
+
+def move_messages_to_table(con: sqlite3.Connection):
+    # Each message is stored once in its own row, rather than rewriting the
+    # whole conversation's JSON every time a message is added.
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS Messages(
+            discord_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            role STRING NOT NULL,
+            content STRING NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (discord_id, seq)
+        ) WITHOUT ROWID;
+        """
+    )
+    con.execute(
+        """
+        INSERT INTO Messages(discord_id, seq, role, content, created_at)
+            SELECT C.discord_id,
+                M.key,
+                json_extract(M.value, '$.role'),
+                json_extract(M.value, '$.content'),
+                C.latest_message
+            FROM Conversations C, json_each(C.llm_message_history) M
+            WHERE C.llm_message_history IS NOT NULL;
+        """
+    )
+    con.execute("ALTER TABLE Conversations DROP COLUMN llm_message_history;")
+
+
+def add_conversation_summaries(con: sqlite3.Connection):
+    con.execute("ALTER TABLE Conversations ADD COLUMN summary STRING;")
+    con.execute(
+        """
+        ALTER TABLE Conversations
+            ADD COLUMN summarised_messages INTEGER NOT NULL DEFAULT 0;
+        """
+    )
+
+
+def add_nudge_responses(con: sqlite3.Connection):
+    # Responses to nudges that don't depend on the conversation, cached so they
+    # can be reused for other players.
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS NudgeResponses(
+            prompt_key STRING NOT NULL,
+            response STRING NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    con.execute(
+        """
+        CREATE INDEX IF NOT EXISTS NudgeResponsesPromptKey
+            ON NudgeResponses(prompt_key, created_at);
+        """
+    )
+
+
+def add_game_session_owner_shards(con: sqlite3.Connection):
+    # When the bot's shards are split across processes, each session is nudged
+    # by the process that claimed it, identified by its lowest shard ID. NULL
+    # for sessions started by an unsharded bot.
+    con.execute("ALTER TABLE GameSessions ADD COLUMN owner_shard INTEGER;")
+
+
+def add_nudge_queue(con: sqlite3.Connection):
+    # Nudges that are due, waiting to be sent by a worker process. Each member
+    # has at most one, which is claimed by a worker until its lease expires.
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS NudgeQueue(
+            discord_id INTEGER PRIMARY KEY,
+            due DATETIME NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_by STRING,
+            lease_expires DATETIME
+        );
+        """
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS NudgeQueueDue ON NudgeQueue(due);")
+
+
+def store_exact_latest_nudges(con: sqlite3.Connection):
+    # latest_nudge used to be set to CURRENT_TIMESTAMP, which is only to the
+    # second. It's now the exact time the nudge was sent, in the same format as
+    # the other datetimes, so it can be compared exactly.
+    con.execute(
+        """
+        UPDATE GameSessions
+            SET latest_nudge = strftime('%Y-%m-%dT%H:%M:%S+00:00', latest_nudge)
+            WHERE latest_nudge NOT LIKE '%+00:00';
+        """
+    )
+
+
+# Append-only: databases record how many of these have been applied.
+MIGRATIONS: list[Callable[[sqlite3.Connection], None]] = [
+    create_tables,
+    add_indexes,
+    move_messages_to_table,
+    add_conversation_summaries,
+    add_nudge_responses,
+    add_game_session_owner_shards,
+    add_nudge_queue,
+    store_exact_latest_nudges,
+]
@@ -1,14 +1,31 @@
-import json
+import asyncio
+from collections import OrderedDict
+from datetime import UTC, datetime, timedelta
 from sqlite3 import Connection
+from typing import Optional
 
+from dataclasses import dataclass, replace
 
-from dataclasses import dataclass
+from stop_playing_factorio.db import connections
+from stop_playing_factorio.db.writer import DatabaseWriter
+from stop_playing_factorio.metrics import timed_query
+
+# Conversations are forgotten after two hours with no more messages.
+CONVERSATION_TTL = timedelta(hours=2)
 
 
 @dataclass
 class Conversation:
     discord_id: int
     llm_message_history: list[object]
+    latest_message: Optional[datetime] = None
+    # How many messages of the history are already stored. Messages are only
+    # ever appended, so only the rest need saving.
+    saved_messages: int = 0
+    # A rolling summary of the first `summarised_messages` messages, which is
+    # sent to the LLM instead of them.
+    summary: Optional[str] = None
+    summarised_messages: int = 0
 
     def add_assistant_message(self, content: str):
         self.llm_message_history.append({"role": "assistant", "content": content})
@@ -16,37 +33,251 @@ class Conversation:
     def add_user_message(self, content: str):
         self.llm_message_history.append({"role": "user", "content": content})
 
+    def take_unsaved_messages(self) -> list[object]:
+        """
+        Returns the unsaved messages, and marks them as saved.
+        """
+        unsaved = self.llm_message_history[self.saved_messages :]
+        self.saved_messages = len(self.llm_message_history)
+        return unsaved
+
 
+@timed_query("get_conversation")
 def get_conversation(con: Connection, discord_id: int) -> Conversation:
-    for (llm_message_history,) in con.execute(
+    for latest_message, summary, summarised_messages in con.execute(
         """
-        SELECT json(llm_message_history)
+        SELECT latest_message, summary, summarised_messages
             FROM Conversations
             WHERE discord_id = ?
             AND latest_message > datetime('now', '-2 hours');
         """,
         (discord_id,),
     ):
-        return Conversation(discord_id, json.loads(llm_message_history))
+        llm_message_history = [
+            {"role": role, "content": content}
+            for role, content in con.execute(
+                """
+                SELECT role, content
+                    FROM Messages
+                    WHERE discord_id = ?
+                    ORDER BY seq;
+                """,
+                (discord_id,),
+            )
+        ]
+        return Conversation(
+            discord_id,
+            llm_message_history,
+            latest_message,
+            len(llm_message_history),
+            summary,
+            summarised_messages,
+        )
     return Conversation(discord_id, [])
 
 
-def save_conversation(con: Connection, conversation: Conversation):
-    llm_message_history_str = json.dumps(conversation.llm_message_history)
+@timed_query("append_messages")
+def append_messages(
+    con: Connection,
+    discord_id: int,
+    messages: list[object],
+    summary: Optional[str] = None,
+    summarised_messages: int = 0,
+):
+    """
+    Adds the messages to the end of the member's stored conversation. They're
+    numbered here, in the write transaction, so that turns saved at the same
+    time (or by other processes) don't both take the same numbers.
+    """
+    # A new conversation replaces any stale one that hasn't been reaped.
+    con.execute(
+        """
+        DELETE FROM Messages
+            WHERE discord_id = ?
+            AND discord_id NOT IN (
+                SELECT discord_id
+                    FROM Conversations
+                    WHERE latest_message > datetime('now', '-2 hours')
+            );
+        """,
+        (discord_id,),
+    )
+    ((first_seq,),) = con.execute(
+        "SELECT COALESCE(MAX(seq) + 1, 0) FROM Messages WHERE discord_id = ?;",
+        (discord_id,),
+    )
     con.executemany(
         """
-        INSERT INTO Conversations(discord_id, llm_message_history) VALUES (?, ?)
+        INSERT INTO Messages(discord_id, seq, role, content) VALUES (?, ?, ?, ?);
+        """,
+        [
+            (discord_id, seq, message["role"], message["content"])
+            for seq, message in enumerate(messages, first_seq)
+        ],
+    )
+    con.execute(
+        """
+        INSERT INTO Conversations(discord_id, summary, summarised_messages)
+            VALUES (?, ?, ?)
             ON CONFLICT(discord_id) DO UPDATE
-                SET llm_message_history = ?, latest_message = CURRENT_TIMESTAMP;
+                SET latest_message = CURRENT_TIMESTAMP,
+                summary = excluded.summary,
+                summarised_messages = excluded.summarised_messages;
         """,
-        [(conversation.discord_id, llm_message_history_str, llm_message_history_str)],
+        (discord_id, summary, summarised_messages),
+    )
+
+
+def save_conversation(con: Connection, conversation: Conversation):
+    append_messages(
+        con,
+        conversation.discord_id,
+        conversation.take_unsaved_messages(),
+        conversation.summary,
+        conversation.summarised_messages,
     )
 
 
+@timed_query("delete_stale_conversations")
 def delete_stale_conversations(con: Connection):
+    con.execute(
+        """
+        DELETE FROM Messages
+            WHERE discord_id IN (
+                SELECT discord_id
+                    FROM Conversations
+                    WHERE (latest_message < datetime('now', '-2 hours'))
+            );
+        """
+    )
     con.execute(
         """
         DELETE FROM Conversations
             WHERE (latest_message < datetime('now', '-2 hours'));
         """
     )
+
+
+class ConversationCache:
+    """
+    An in-memory, least-recently-used cache of conversations, so that active
+    chats don't need to read and parse their history from the database on
+    every turn.
+
+    Saved conversations are written through to the database by the database
+    writer, and dropped from the cache if the write fails, so the cache doesn't
+    drift from the database. Conversations are dropped once they're stale, and
+    the least-recently-used ones are evicted beyond `max_conversations` or
+    (roughly) `max_bytes` of message content. A `max_conversations` of 0
+    turns the cache off, for when other processes write to the same
+    conversations.
+    """
+
+    def __init__(
+        self,
+        db_writer: DatabaseWriter,
+        max_conversations: int = 10_000,
+        max_bytes: int = 16 * 1024 * 1024,
+    ):
+        self.db_writer = db_writer
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.resident_bytes = 0
+        self._conversations: OrderedDict[int, tuple[Conversation, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def get(self, discord_id: int) -> Conversation:
+        """
+        Returns a copy of the member's conversation, which can be changed
+        freely until it's saved.
+        """
+        cached = self._conversations.get(discord_id)
+        if cached and not self._is_stale(cached[0]):
+            self.hits += 1
+            self._conversations.move_to_end(discord_id)
+            conversation = cached[0]
+        else:
+            self.misses += 1
+            with connections.reader() as con:
+                conversation = get_conversation(con, discord_id)
+            self._put(conversation)
+        return replace(
+            conversation, llm_message_history=list(conversation.llm_message_history)
+        )
+
+    async def save(self, conversation: Conversation):
+        conversation.latest_message = datetime.now(tz=UTC)
+        cached = self._conversations.get(conversation.discord_id)
+        if cached and len(cached[0].llm_message_history) != conversation.saved_messages:
+            # Another turn has been saved since this copy was taken, so neither
+            # has the whole conversation. The next turn reads it back from the
+            # database, where both turns' messages end up.
+            self._remove(conversation.discord_id)
+        else:
+            self._put(conversation)
+        # The unsaved messages are taken here rather than on the writer thread,
+        # so that copies handed out by `get` know they've been saved.
+        committed = await self.db_writer.submit(
+            append_messages,
+            conversation.discord_id,
+            conversation.take_unsaved_messages(),
+            conversation.summary,
+            conversation.summarised_messages,
+        )
+        if self.max_conversations:
+            committed.add_done_callback(
+                lambda future: self._forget_if_failed(conversation.discord_id, future)
+            )
+            return
+        # Without caching, the next turn reads the conversation back from the
+        # database, so it needs to be there.
+        try:
+            await committed
+        except Exception:
+            # Already logged by the writer. The messages have been sent by
+            # now, so there's nothing more to do about it.
+            pass
+
+    def _forget_if_failed(self, discord_id: int, committed: asyncio.Future):
+        # The cached conversation counts messages as saved that aren't, so the
+        # next turn reads back what the database actually has.
+        if not committed.cancelled() and committed.exception():
+            self._remove(discord_id)
+
+    def evict_stale(self):
+        for discord_id, (conversation, _) in list(self._conversations.items()):
+            if self._is_stale(conversation):
+                self._remove(discord_id)
+
+    def _put(self, conversation: Conversation):
+        self._remove(conversation.discord_id)
+        size = sum(
+            len(message["content"]) for message in conversation.llm_message_history
+        )
+        self._conversations[conversation.discord_id] = (conversation, size)
+        self.resident_bytes += size
+        while self._conversations and (
+            len(self._conversations) > self.max_conversations
+            or self.resident_bytes > self.max_bytes
+        ):
+            self._remove(next(iter(self._conversations)))
+
+    def _remove(self, discord_id: int):
+        cached = self._conversations.pop(discord_id, None)
+        if cached:
+            self.resident_bytes -= cached[1]
+
+    def _is_stale(self, conversation: Conversation) -> bool:
+        return (
+            conversation.latest_message is not None
+            and conversation.latest_message < datetime.now(tz=UTC) - CONVERSATION_TTL
+        )
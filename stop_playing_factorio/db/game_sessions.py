@@ -1,12 +1,19 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import UTC, datetime, timedelta
+import json
 from typing import Generator, Optional
 
 import pytz
+from pytz.tzinfo import BaseTzInfo
 from sqlite3 import Connection
 
+from stop_playing_factorio.metrics import timed_query
 
-@dataclass
+
+_UNSET = object()
+
+
+@dataclass(slots=True)
 class GameSession:
     discord_id: int
     started_at: datetime
@@ -15,9 +22,21 @@ class GameSession:
     latest_nudge: datetime
     time_zone_str: Optional[str]
 
+    # Derived values, cached on the instance. The next nudge depends on
+    # `latest_nudge`, which changes when the session is nudged, so that's cached
+    # alongside the `latest_nudge` it was calculated from.
+    _time_zone: Optional[BaseTzInfo] = field(default=None, init=False, repr=False)
+    _lateness_threshold: Optional[datetime] = field(
+        default=None, init=False, repr=False
+    )
+    _next_nudge_due: Optional[datetime] = field(default=None, init=False, repr=False)
+    _next_nudge_due_for: object = field(default=_UNSET, init=False, repr=False)
+
     @property
-    def time_zone(self):
-        return pytz.timezone(self.time_zone_str or "Europe/London")
+    def time_zone(self) -> BaseTzInfo:
+        if self._time_zone is None:
+            self._time_zone = pytz.timezone(self.time_zone_str or "Europe/London")
+        return self._time_zone
 
     @property
     def next_duration_nudge_due(self) -> datetime:
@@ -28,11 +47,12 @@ class GameSession:
 
         Nudges are due every `duration_nudge_frequency` minutes.
         """
-        next_duration_nudge_due = self.started_at
         latest_nudge = self.latest_nudge or self.started_at
-        while next_duration_nudge_due <= latest_nudge:
-            next_duration_nudge_due += timedelta(minutes=self.duration_nudge_frequency)
-        return next_duration_nudge_due
+        return _next_multiple_after(
+            self.started_at,
+            timedelta(minutes=self.duration_nudge_frequency),
+            latest_nudge,
+        )
 
     @property
     def lateness_threshold(self) -> datetime:
@@ -41,15 +61,16 @@ class GameSession:
         this is 11pm local time on the day the game session starts (or the day
         before if the session starts between midnight and 6am).
         """
-        local_started_at = self.started_at.astimezone(self.time_zone)
-        local_lateness_threshold = local_started_at.replace(
-            hour=6, minute=0, second=0, microsecond=0
-        )
-        if local_lateness_threshold < local_started_at:
-            local_lateness_threshold += timedelta(days=1)
-        local_lateness_threshold -= timedelta(hours=7)
-        lateness_threshold = local_lateness_threshold.astimezone(pytz.utc)
-        return lateness_threshold
+        if self._lateness_threshold is None:
+            local_started_at = self.started_at.astimezone(self.time_zone)
+            local_lateness_threshold = local_started_at.replace(
+                hour=6, minute=0, second=0, microsecond=0
+            )
+            if local_lateness_threshold < local_started_at:
+                local_lateness_threshold += timedelta(days=1)
+            local_lateness_threshold -= timedelta(hours=7)
+            self._lateness_threshold = local_lateness_threshold.astimezone(pytz.utc)
+        return self._lateness_threshold
 
     @property
     def next_lateness_nudge_due(self) -> datetime:
@@ -59,47 +80,104 @@ class GameSession:
         time, and are then due every `lateness_nudge_frequency` minutes
         afterwards.
         """
-        next_lateness_nudge_due = self.lateness_threshold
-        if self.latest_nudge:
-            while next_lateness_nudge_due <= self.latest_nudge:
-                next_lateness_nudge_due += timedelta(
-                    minutes=self.lateness_nudge_frequency
-                )
-        return next_lateness_nudge_due
+        if not self.latest_nudge:
+            return self.lateness_threshold
+        return _next_multiple_after(
+            self.lateness_threshold,
+            timedelta(minutes=self.lateness_nudge_frequency),
+            self.latest_nudge,
+        )
 
     @property
     def next_nudge_due(self) -> datetime:
-        return (
-            max(self.next_duration_nudge_due, self.next_lateness_nudge_due)
-            if abs(self.next_duration_nudge_due - self.next_lateness_nudge_due)
-            < timedelta(minutes=15)
-            else min(self.next_duration_nudge_due, self.next_lateness_nudge_due)
-        )
+        if self._next_nudge_due_for is not self.latest_nudge:
+            next_duration_nudge_due = self.next_duration_nudge_due
+            next_lateness_nudge_due = self.next_lateness_nudge_due
+            self._next_nudge_due = (
+                max(next_duration_nudge_due, next_lateness_nudge_due)
+                if abs(next_duration_nudge_due - next_lateness_nudge_due)
+                < timedelta(minutes=15)
+                else min(next_duration_nudge_due, next_lateness_nudge_due)
+            )
+            self._next_nudge_due_for = self.latest_nudge
+        return self._next_nudge_due
 
     @property
     def duration(self) -> timedelta:
         return datetime.now(pytz.utc) - self.started_at
 
 
-def get_game_sessions(con: Connection) -> Generator[GameSession, None, None]:
-    for row in con.execute(
-        """
-        SELECT GS.discord_id,
-            GS.started_at,
-            GS.duration_nudge_frequency,
-            GS.lateness_nudge_frequency,
-            GS.latest_nudge,
-            US.time_zone
-        FROM GameSessions GS
-            LEFT JOIN UserStates US ON GS.discord_id = US.discord_id
-            WHERE GS.ended_at IS NULL
-            AND GS.muted = FALSE
-            AND US.blocked IS NOT TRUE;
-        """
-    ):
+_SELECT_ACTIVE_GAME_SESSIONS = """
+    SELECT GS.discord_id,
+        GS.started_at,
+        GS.duration_nudge_frequency,
+        GS.lateness_nudge_frequency,
+        GS.latest_nudge,
+        US.time_zone
+    FROM GameSessions GS
+        LEFT JOIN UserStates US ON GS.discord_id = US.discord_id
+        WHERE GS.ended_at IS NULL
+        AND GS.muted = FALSE
+        AND US.blocked IS NOT TRUE
+"""
+
+# Restricts a query to the sessions owned by a list of shards (passed as JSON),
+# when the bot's shards are split across processes.
+_OWNED_BY_SHARDS = "owner_shard IN (SELECT value FROM json_each(?))"
+
+
+def _next_multiple_after(start: datetime, step: timedelta, after: datetime):
+    """
+    Returns the first time `start + n * step` (for n >= 0) that's later than
+    `after`.
+    """
+    if after < start:
+        return start
+    return start + ((after - start) // step + 1) * step
+
+
+@timed_query("get_game_sessions")
+def get_game_sessions(
+    con: Connection, shard_ids: Optional[list[int]] = None
+) -> Generator[GameSession, None, None]:
+    """
+    Yields the game sessions that can be nudged, only including the ones owned
+    by `shard_ids` if given.
+    """
+    if shard_ids is None:
+        rows = con.execute(f"{_SELECT_ACTIVE_GAME_SESSIONS};")
+    else:
+        rows = con.execute(
+            f"{_SELECT_ACTIVE_GAME_SESSIONS} AND GS.{_OWNED_BY_SHARDS};",
+            (json.dumps(shard_ids),),
+        )
+    for row in rows:
         yield GameSession(*row)
 
 
+@timed_query("get_game_session")
+def get_game_session(
+    con: Connection, discord_id: int, shard_ids: Optional[list[int]] = None
+) -> Optional[GameSession]:
+    """
+    Returns the member's game session, if they're in one that can be nudged
+    (and it's owned by `shard_ids`, if given).
+    """
+    if shard_ids is None:
+        rows = con.execute(
+            f"{_SELECT_ACTIVE_GAME_SESSIONS} AND GS.discord_id = ?;", (discord_id,)
+        )
+    else:
+        rows = con.execute(
+            f"{_SELECT_ACTIVE_GAME_SESSIONS} AND GS.discord_id = ? "
+            f"AND GS.{_OWNED_BY_SHARDS};",
+            (discord_id, json.dumps(shard_ids)),
+        )
+    for row in rows:
+        return GameSession(*row)
+
+
+@timed_query("is_in_game_session")
 def is_in_game_session(con: Connection, discord_id: int) -> bool:
     for _ in con.execute(
         """
@@ -114,61 +192,170 @@ def is_in_game_session(con: Connection, discord_id: int) -> bool:
     return False
 
 
+@timed_query("start_game_session")
 def start_game_session(
-    con: Connection, discord_id: int, started_at: Optional[datetime]
+    con: Connection,
+    discord_id: int,
+    started_at: Optional[datetime],
+    owner_shard: Optional[int] = None,
 ):
+    """
+    Starts (or restarts) the member's game session. A session that's already
+    active keeps its owner, unless it doesn't have one, so the first shard to
+    see a member start playing nudges them.
+    """
     con.executemany(
         """
-        INSERT INTO GameSessions(discord_id, started_at) VALUES (?, ?)
-            ON CONFLICT(discord_id) DO UPDATE SET ended_at = NULL;
+        INSERT INTO GameSessions(discord_id, started_at, owner_shard)
+            VALUES (?, ?, ?)
+            ON CONFLICT(discord_id) DO UPDATE SET
+                owner_shard = CASE
+                    WHEN ended_at IS NOT NULL OR owner_shard IS NULL
+                    THEN excluded.owner_shard
+                    ELSE owner_shard
+                END,
+                ended_at = NULL;
         """,
-        [(discord_id, started_at or datetime.now(tz=UTC))],
+        [(discord_id, started_at or datetime.now(tz=UTC), owner_shard)],
     )
 
 
-def start_game_sessions(
-    con: Connection, actively_playing_members: list[int, Optional[datetime]]
+@timed_query("stop_game_session")
+def stop_game_session(
+    con: Connection, discord_id: int, shard_ids: Optional[list[int]] = None
 ):
-    con.executemany(
+    """
+    Stops the member's game session, unless it's owned by a shard other than
+    `shard_ids` (if given).
+    """
+    if shard_ids is None:
+        con.execute(
+            """
+            UPDATE GameSessions
+                SET ended_at = CURRENT_TIMESTAMP
+                WHERE ended_at IS NULL
+                AND discord_id = ?
+            """,
+            (discord_id,),
+        )
+    else:
+        con.execute(
+            f"""
+            UPDATE GameSessions
+                SET ended_at = CURRENT_TIMESTAMP
+                WHERE ended_at IS NULL
+                AND discord_id = ?
+                AND (owner_shard IS NULL OR {_OWNED_BY_SHARDS})
+            """,
+            (discord_id, json.dumps(shard_ids)),
+        )
+
+
+@dataclass
+class SyncResult:
+    started: int
+    stopped: int
+    unchanged: int
+    # Unchanged sessions without an owner, which have been claimed.
+    claimed: int = 0
+
+
+@timed_query("sync_game_sessions")
+def sync_game_sessions(
+    con: Connection,
+    actively_playing_members: list[tuple[int, Optional[datetime]]],
+    owner_shard: Optional[int] = None,
+    shard_ids: Optional[list[int]] = None,
+) -> SyncResult:
+    """
+    Starts game sessions for actively playing members who aren't in one, and
+    stops every other active session. Should be run as a single write, so that
+    a sync that fails part-way through changes nothing.
+
+    If `shard_ids` is given, only the sessions owned by those shards (or not
+    owned by any) are stopped, as members of other shards' guilds won't be in
+    the list. Sessions started here, or without an owner, are claimed for
+    `owner_shard`.
+
+    The members are bulk-loaded into a temporary table and compared against
+    the sessions table there, as sqlite3 doesn't support array inputs.
+    """
+    con.execute(
         """
-        INSERT INTO GameSessions(discord_id, started_at) VALUES (?, ?)
-            ON CONFLICT(discord_id) DO UPDATE SET ended_at = NULL;
-        """,
-        [
+        CREATE TEMP TABLE IF NOT EXISTS ActivelyPlaying(
+            discord_id INTEGER PRIMARY KEY,
+            started_at DATETIME NOT NULL
+        );
+        """
+    )
+    # The table is only emptied at the end, so clear out anything left by a
+    # sync that failed part-way through.
+    con.execute("DELETE FROM ActivelyPlaying;")
+    con.executemany(
+        "INSERT OR IGNORE INTO ActivelyPlaying(discord_id, started_at) VALUES (?, ?);",
+        (
             (discord_id, started_at or datetime.now(tz=UTC))
             for discord_id, started_at in actively_playing_members
-        ],
+        ),
     )
-
-
-def stop_game_session(con: Connection, discord_id: int):
-    con.execute(
+    ((unchanged,),) = con.execute(
+        """
+        SELECT COUNT(*)
+            FROM ActivelyPlaying AP
+            JOIN GameSessions GS ON GS.discord_id = AP.discord_id
+            WHERE GS.ended_at IS NULL;
         """
-        UPDATE GameSessions
-            SET ended_at = CURRENT_TIMESTAMP
-            WHERE ended_at IS NULL
-            AND discord_id = ?
-        """,
-        (discord_id,),
     )
-
-
-def stop_inactive_game_sessions(
-    con: Connection, actively_playing_members: list[int, Optional[datetime]]
-):
-    # sqlite3 doesn't support array inputs - this should be fine as long as the
-    # bot's not trying to bother a thousand people at once.
-    con.execute(
-        f"""
-        UPDATE GameSessions
-            SET ended_at = CURRENT_TIMESTAMP
-            WHERE ended_at IS NULL
-            AND discord_id NOT IN ({','.join('?' * len(actively_playing_members))});
+    if shard_ids is None:
+        stopped = con.execute(
+            """
+            UPDATE GameSessions
+                SET ended_at = CURRENT_TIMESTAMP
+                WHERE ended_at IS NULL
+                AND discord_id NOT IN (SELECT discord_id FROM ActivelyPlaying);
+            """
+        ).rowcount
+    else:
+        stopped = con.execute(
+            f"""
+            UPDATE GameSessions
+                SET ended_at = CURRENT_TIMESTAMP
+                WHERE ended_at IS NULL
+                AND discord_id NOT IN (SELECT discord_id FROM ActivelyPlaying)
+                AND (owner_shard IS NULL OR {_OWNED_BY_SHARDS});
+            """,
+            (json.dumps(shard_ids),),
+        ).rowcount
+    claimed = 0
+    if owner_shard is not None:
+        ((claimed,),) = con.execute(
+            """
+            SELECT COUNT(*)
+                FROM ActivelyPlaying AP
+                JOIN GameSessions GS ON GS.discord_id = AP.discord_id
+                WHERE GS.ended_at IS NULL
+                AND GS.owner_shard IS NULL;
+            """
+        )
+    # The `WHERE true` is needed by SQLite's parser for an upsert from a
+    # SELECT. Its row count includes the sessions that were claimed.
+    upserted = con.execute(
+        """
+        INSERT INTO GameSessions(discord_id, started_at, owner_shard)
+            SELECT discord_id, started_at, ? FROM ActivelyPlaying WHERE true
+            ON CONFLICT(discord_id) DO UPDATE SET
+                ended_at = NULL,
+                owner_shard = excluded.owner_shard
+                WHERE ended_at IS NOT NULL
+                OR (owner_shard IS NULL AND excluded.owner_shard IS NOT NULL);
         """,
-        [discord_id for discord_id, _ in actively_playing_members],
-    )
+        (owner_shard,),
+    ).rowcount
+    con.execute("DELETE FROM ActivelyPlaying;")
+    return SyncResult(upserted - claimed, stopped, unchanged, claimed)
 
 
+@timed_query("delete_stale_game_sessions")
 def delete_stale_game_sessions(con: Connection):
     con.execute(
         """
@@ -178,12 +365,19 @@ def delete_stale_game_sessions(con: Connection):
     )
 
 
-def update_latest_nudge(con: Connection, discord_id: int):
+@timed_query("update_latest_nudge")
+def update_latest_nudge(con: Connection, discord_id: int, latest_nudge: datetime):
+    """
+    Records when the member was nudged. This is the time the bot has in
+    memory, rather than `CURRENT_TIMESTAMP`: that's only to the second, so a
+    session reloaded with it would look like it hadn't been nudged for the
+    nudge that was just sent.
+    """
     con.execute(
         """
         UPDATE GameSessions
-            SET latest_nudge = CURRENT_TIMESTAMP
+            SET latest_nudge = ?
             WHERE discord_id = ?
         """,
-        (discord_id,),
+        (latest_nudge, discord_id),
     )
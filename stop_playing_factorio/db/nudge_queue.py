@@ -0,0 +1,142 @@
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from sqlite3 import Connection
+from typing import Optional
+
+from stop_playing_factorio.metrics import timed_query
+
+
+@dataclass
+class ClaimedNudge:
+    discord_id: int
+    due: datetime
+    # Including this one.
+    attempts: int
+
+
+def _as_datetime(value) -> datetime:
+    # Columns returned by `RETURNING` don't go through the DATETIME converter.
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value).replace(tzinfo=UTC)
+
+
+@timed_query("enqueue_nudge")
+def enqueue_nudge(
+    con: Connection, discord_id: int, due: datetime, latest_nudge: Optional[datetime]
+) -> bool:
+    """
+    Queues a nudge for the member, unless one's already queued, their game
+    session has ended, or they've been nudged since `latest_nudge` (i.e. a
+    worker has sent the nudge since the scheduler loaded the session). Returns
+    whether it was queued.
+
+    `latest_nudge` is compared exactly, as it's stored to the microsecond (in
+    the format it's read back in), so any nudge sent since changes it.
+    """
+    return (
+        con.execute(
+            """
+            INSERT INTO NudgeQueue(discord_id, due)
+                SELECT discord_id, ?
+                    FROM GameSessions
+                    WHERE discord_id = ?
+                    AND ended_at IS NULL
+                    AND latest_nudge IS ?
+                ON CONFLICT(discord_id) DO NOTHING;
+            """,
+            (due, discord_id, latest_nudge),
+        ).rowcount
+        == 1
+    )
+
+
+@timed_query("claim_nudges")
+def claim_nudges(
+    con: Connection, worker_id: str, limit: int, lease_expires: datetime
+) -> list[ClaimedNudge]:
+    """
+    Claims up to `limit` due nudges for the worker, until `lease_expires`.
+    Nudges claimed by a worker whose lease has expired (e.g. because it
+    crashed) can be claimed again.
+    """
+    now = datetime.now(tz=UTC)
+    return [
+        ClaimedNudge(discord_id, _as_datetime(due), attempts)
+        for discord_id, due, attempts in con.execute(
+            """
+            UPDATE NudgeQueue
+                SET claimed_by = ?, lease_expires = ?, attempts = attempts + 1
+                WHERE discord_id IN (
+                    SELECT discord_id
+                        FROM NudgeQueue
+                        WHERE due <= ?
+                        AND (lease_expires IS NULL OR lease_expires < ?)
+                        ORDER BY due
+                        LIMIT ?
+                )
+                RETURNING discord_id, due, attempts;
+            """,
+            (worker_id, lease_expires, now, now, limit),
+        ).fetchall()
+    ]
+
+
+@timed_query("renew_nudge_leases")
+def renew_nudge_leases(con: Connection, worker_id: str, lease_expires: datetime):
+    con.execute(
+        "UPDATE NudgeQueue SET lease_expires = ? WHERE claimed_by = ?;",
+        (lease_expires, worker_id),
+    )
+
+
+@timed_query("complete_nudge")
+def complete_nudge(
+    con: Connection,
+    discord_id: int,
+    worker_id: str,
+    latest_nudge: Optional[datetime],
+):
+    """
+    Removes the worker's claimed nudge from the queue, and records when the
+    member was nudged if it was sent (`latest_nudge` is None if it wasn't).
+    The database writer applies both or neither (see `DatabaseWriter`), so the
+    scheduler never sees the nudge as neither queued nor sent, and queues it
+    again.
+    """
+    con.execute(
+        "DELETE FROM NudgeQueue WHERE discord_id = ? AND claimed_by = ?;",
+        (discord_id, worker_id),
+    )
+    if latest_nudge is not None:
+        con.execute(
+            """
+            UPDATE GameSessions
+                SET latest_nudge = ?
+                WHERE discord_id = ?
+            """,
+            (latest_nudge, discord_id),
+        )
+
+
+@timed_query("release_nudge")
+def release_nudge(con: Connection, discord_id: int, worker_id: str, retry_at: datetime):
+    """
+    Puts a nudge the worker couldn't send back in the queue, to be retried at
+    `retry_at`.
+    """
+    con.execute(
+        """
+        UPDATE NudgeQueue
+            SET due = ?, claimed_by = NULL, lease_expires = NULL
+            WHERE discord_id = ?
+            AND claimed_by = ?;
+        """,
+        (retry_at, discord_id, worker_id),
+    )
+
+
+@timed_query("count_queued_nudges")
+def count_queued_nudges(con: Connection) -> int:
+    ((count,),) = con.execute("SELECT COUNT(*) FROM NudgeQueue;")
+    return count
@@ -0,0 +1,162 @@
+from collections import OrderedDict
+from datetime import UTC, datetime, timedelta
+import hashlib
+import random
+from sqlite3 import Connection
+from typing import Generator, Optional
+
+from stop_playing_factorio.db.writer import DatabaseWriter
+from stop_playing_factorio.metrics import timed_query
+
+# Cached responses are regenerated after a day, so nudges don't go stale.
+NUDGE_RESPONSE_TTL = timedelta(days=1)
+
+# Stands in for the player's handle in cached prompts and responses.
+PLAYER_PLACEHOLDER = "<@player>"
+
+
+def nudge_response_key(instructions: str, prompt: str, player_handle: str) -> str:
+    """
+    Returns the cache key for a nudge request with no conversation history.
+    The player's handle is replaced with a placeholder, so that the request is
+    the same for every player with the same prompt.
+    """
+    request = f"{instructions}\n{prompt}".replace(player_handle, PLAYER_PLACEHOLDER)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+@timed_query("get_nudge_responses")
+def get_nudge_responses(
+    con: Connection,
+) -> Generator[tuple[str, str, datetime], None, None]:
+    yield from con.execute(
+        """
+        SELECT prompt_key, response, created_at
+            FROM NudgeResponses
+            WHERE created_at > datetime('now', '-1 day')
+            ORDER BY created_at;
+        """
+    )
+
+
+@timed_query("add_nudge_response")
+def add_nudge_response(con: Connection, prompt_key: str, response: str, pool_size: int):
+    con.execute(
+        "INSERT INTO NudgeResponses(prompt_key, response) VALUES (?, ?);",
+        (prompt_key, response),
+    )
+    # Only the newest responses in the pool are kept.
+    con.execute(
+        """
+        DELETE FROM NudgeResponses
+            WHERE prompt_key = ?
+            AND rowid NOT IN (
+                SELECT rowid
+                    FROM NudgeResponses
+                    WHERE prompt_key = ?
+                    ORDER BY created_at DESC, rowid DESC
+                    LIMIT ?
+            );
+        """,
+        (prompt_key, prompt_key, pool_size),
+    )
+
+
+@timed_query("delete_stale_nudge_responses")
+def delete_stale_nudge_responses(con: Connection):
+    con.execute(
+        """
+        DELETE FROM NudgeResponses
+            WHERE created_at < datetime('now', '-1 day');
+        """
+    )
+
+
+class NudgeResponseCache:
+    """
+    Caches the LLM's responses to nudges for members with no conversation
+    history. Their requests only differ by the player's handle, and there are
+    only a few different nudge prompts, so most of these nudges can be answered
+    without an API call.
+
+    Each prompt has a pool of up to `pool_size` responses, so that players
+    don't all get the same one. Until the pool is full, responses aren't
+    served from the cache, and the new responses are added to it. Responses
+    expire after `NUDGE_RESPONSE_TTL`, and the least-recently-used prompts are
+    evicted beyond `max_prompts`. Responses are written through to the
+    database, so they survive restarts.
+    """
+
+    def __init__(
+        self,
+        db_writer: DatabaseWriter,
+        pool_size: int = 5,
+        max_prompts: int = 1000,
+    ):
+        self.db_writer = db_writer
+        self.pool_size = pool_size
+        self.max_prompts = max_prompts
+        self.hits = 0
+        self.misses = 0
+        self._pools: OrderedDict[str, list[tuple[str, datetime]]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._pools)
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def load(self, con: Connection):
+        self._pools = OrderedDict()
+        for prompt_key, response, created_at in get_nudge_responses(con):
+            self._add(prompt_key, response, created_at)
+
+    def get(self, prompt_key: str, player_handle: str) -> Optional[str]:
+        """
+        Returns a random response from the prompt's pool, for the player, if
+        the pool is full.
+        """
+        pool = self._fresh_pool(prompt_key)
+        if len(pool) < self.pool_size:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pools.move_to_end(prompt_key)
+        response, _ = random.choice(pool)
+        return response.replace(PLAYER_PLACEHOLDER, player_handle)
+
+    async def add(self, prompt_key: str, response: str, player_handle: str):
+        response = response.replace(player_handle, PLAYER_PLACEHOLDER)
+        self._add(prompt_key, response, datetime.now(tz=UTC))
+        await self.db_writer.submit(
+            add_nudge_response, prompt_key, response, self.pool_size
+        )
+
+    def evict_stale(self):
+        for prompt_key in list(self._pools):
+            self._fresh_pool(prompt_key)
+
+    def _add(self, prompt_key: str, response: str, created_at: datetime):
+        pool = self._fresh_pool(prompt_key)
+        pool.append((response, created_at))
+        self._pools[prompt_key] = pool[-self.pool_size :]
+        self._pools.move_to_end(prompt_key)
+        while len(self._pools) > self.max_prompts:
+            self._pools.popitem(last=False)
+
+    def _fresh_pool(self, prompt_key: str) -> list[tuple[str, datetime]]:
+        """
+        Drops the prompt's expired responses, and returns the rest.
+        """
+        pool = self._pools.get(prompt_key)
+        if pool is None:
+            return []
+        expires_before = datetime.now(tz=UTC) - NUDGE_RESPONSE_TTL
+        pool = [entry for entry in pool if entry[1] > expires_before]
+        if pool:
+            self._pools[prompt_key] = pool
+        else:
+            del self._pools[prompt_key]
+        return pool
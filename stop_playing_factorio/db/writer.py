@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from stop_playing_factorio.db import connections
+
+logger = logging.getLogger()
+
+# Writes are queued as (function, args, future) tuples, where the function
+# takes the writer's connection as its first argument, e.g.
+# `start_game_session`.
+Write = tuple[Callable[..., Any], tuple, Optional[asyncio.Future]]
+
+_STOP = object()
+
+
+class DatabaseWriter:
+    """
+    Owns the one connection that writes to the database (see
+    `ConnectionManager`), on a background thread.
+
+    Event handlers queue up writes and return straight away. The thread
+    collects whatever's been queued over `batch_interval` seconds (up to
+    `max_batch_size` writes) and applies the lot in a single transaction.
+    Each write is all-or-nothing: one that fails is rolled back to a savepoint
+    without affecting the rest of the batch. If the thread falls behind, the
+    queue fills up to `max_queue_size` and callers wait for space.
+    """
+
+    def __init__(
+        self,
+        batch_interval: float = 0.005,
+        max_batch_size: int = 500,
+        max_queue_size: int = 10_000,
+    ):
+        self.batch_interval = batch_interval
+        self.max_batch_size = max_batch_size
+        # Only updated by the writer thread.
+        self.writes = 0
+        self.batches = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread = threading.Thread(
+            target=self._run, name="spfbot-db-writer", daemon=True
+        )
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def submit(self, fn: Callable[..., Any], *args) -> asyncio.Future:
+        """
+        Queues a write, only waiting if the queue is full. The returned future
+        resolves with the function's return value once its batch has been
+        committed, but doesn't need to be awaited.
+        """
+        future = self._loop.create_future()
+        # Failures are already logged by the writer thread, so it's fine for
+        # callers to never look at the result.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        write = (fn, args, future)
+        try:
+            self._queue.put_nowait(write)
+        except queue.Full:
+            logger.warning("Database write queue is full, waiting for space...")
+            await asyncio.to_thread(self._queue.put, write)
+        return future
+
+    async def flush(self):
+        """
+        Waits until everything queued so far has been committed.
+        """
+        await asyncio.to_thread(self._queue.join)
+
+    async def close(self):
+        """
+        Commits anything still queued, then stops the thread.
+        """
+        if not self._thread.is_alive():
+            return
+        await asyncio.to_thread(self._queue.put, (_STOP, (), None))
+        await asyncio.to_thread(self._thread.join)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.max_batch_size and batch[-1][0] is not _STOP:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._commit(connections.writer(), [w for w in batch if w[0] is not _STOP])
+            for _ in batch:
+                self._queue.task_done()
+            if batch[-1][0] is _STOP:
+                return
+
+    def _commit(self, con: sqlite3.Connection, batch: list[Write]):
+        if not batch:
+            return
+        results = []
+        try:
+            con.execute("BEGIN")
+            for fn, args, _future in batch:
+                # Each write runs in its own savepoint, so a write that fails
+                # part-way through is rolled back as a whole (SQLite only
+                # rolls back the failed statement itself), and the rest of the
+                # batch can still be committed.
+                con.execute("SAVEPOINT write")
+                try:
+                    result = fn(con, *args)
+                except Exception as e:
+                    logger.error(f"Database write {fn.__name__} failed", exc_info=True)
+                    con.execute("ROLLBACK TO write")
+                    results.append((None, e))
+                else:
+                    results.append((result, None))
+                finally:
+                    con.execute("RELEASE write")
+            con.execute("COMMIT")
+            self.writes += len(batch)
+            self.batches += 1
+        except Exception as e:
+            logger.error("Could not commit database writes", exc_info=True)
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            results = [(None, e)] * len(batch)
+
+        for (_fn, _args, future), (result, error) in zip(batch, results):
+            if future is not None:
+                self._resolve(future, result, error)
+
+    def _resolve(self, future: asyncio.Future, result: Any, error: Optional[Exception]):
+        def resolve():
+            if future.cancelled():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        try:
+            self._loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            # The event loop has already closed during shutdown.
+            pass
@@ -1,34 +1,97 @@
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
 import logging
-import sqlite3
+import time
 import pytz
-from typing import Optional
+from typing import Iterable, Optional
 
 import discord
 from discord.ext import commands, tasks
 
-from stop_playing_factorio.db import connect
+from stop_playing_factorio.db import connections
+from stop_playing_factorio.db.nudge_responses import (
+    NudgeResponseCache,
+    delete_stale_nudge_responses,
+    nudge_response_key,
+)
+from stop_playing_factorio.db.writer import DatabaseWriter
 from stop_playing_factorio.db.game_sessions import (
     GameSession,
     delete_stale_game_sessions,
+    get_game_session,
     get_game_sessions,
     is_in_game_session,
     start_game_session,
-    start_game_sessions,
     stop_game_session,
-    stop_inactive_game_sessions,
+    sync_game_sessions,
     update_latest_nudge,
 )
 from stop_playing_factorio.db.conversations import (
+    Conversation,
+    ConversationCache,
     delete_stale_conversations,
-    get_conversation,
-    save_conversation,
 )
-from stop_playing_factorio.llm import get_instructions, query_llm
+from stop_playing_factorio.llm import (
+    FALLBACK_REPLY,
+    LLMUnavailableError,
+    close_client,
+    get_instructions,
+    query_llm,
+    stats as llm_stats,
+    stream_llm,
+)
 from stop_playing_factorio.llm.nudge_prompt import get_nudge_prompt
+from stop_playing_factorio import metrics
+from stop_playing_factorio.log_pipeline import PRESENCE_LOGGER
+from stop_playing_factorio.metrics import timed_handler
+from stop_playing_factorio.nudge_scheduler import (
+    NudgeLag,
+    NudgeScheduler,
+    PregeneratedNudge,
+)
+from stop_playing_factorio.presence_coalescer import PresenceCoalescer
 
 
 logger = logging.getLogger()
+# Rate limited, as there can be a lot of these.
+presence_logger = logging.getLogger(PRESENCE_LOGGER)
+
+# Nudges that fail are retried after this long, doubling with each failure in
+# a row up to the maximum.
+NUDGE_RETRY_DELAY = timedelta(minutes=1)
+MAX_NUDGE_RETRY_DELAY = timedelta(minutes=30)
+
+# Nudges due within this long are generated ahead of time, so they only need
+# sending when they're due.
+PREGENERATE_NUDGES_AHEAD = timedelta(minutes=5)
+
+# Discord allows about five edits to messages in a channel every five seconds.
+STREAM_EDIT_INTERVAL = 1.2
+# Added to a streamed reply that fails after some of it has been posted.
+STREAM_CUT_OFF_NOTE = "… (sorry, I got cut off)"
+
+# The full scan of every guild member is only run as an audit, on every Nth
+# sync (including the first).
+AUDIT_EVERY_N_SYNCS = 24
+SCAN_CHUNK_SIZE = 1000
+
+QUEUE_DEPTH = metrics.gauge(
+    "spfbot_queue_depth", "Work waiting to be done by the bot.", ["queue"]
+)
+CACHE_ENTRIES = metrics.gauge(
+    "spfbot_cache_entries", "Entries held in the bot's in-memory caches.", ["cache"]
+)
+ACTIVE_GAME_SESSIONS = metrics.gauge(
+    "spfbot_active_game_sessions", "Game sessions scheduled to be nudged."
+)
+PLAYING_MEMBERS = metrics.gauge(
+    "spfbot_playing_members", "Members currently playing the game."
+)
+PRESENCE_UPDATES = metrics.counter(
+    "spfbot_presence_updates_total",
+    "Presence updates seen by the coalescer, by what happened to them.",
+    ["outcome"],
+)
 
 
 class GameWatchBot(commands.Bot):
@@ -45,20 +108,76 @@ class GameWatchBot(commands.Bot):
         self,
         game: str,
         *args,
+        presence_debounce_seconds: float = 10.0,
+        nudge_concurrency: int = 8,
+        stream_replies: bool = False,
+        metrics_port: Optional[int] = None,
+        conversation_cache_size: int = 10_000,
+        send_nudges: bool = True,
+        lean_member_cache: bool = False,
         **kwargs,
     ):
         intents = discord.Intents.default()
-        intents.members = True
         intents.presences = True
+        if lean_member_cache:
+            # Members aren't cached (or chunked), so presences arrive as raw
+            # events, and the only member state kept is the index of who's
+            # playing the game.
+            intents.members = False
+            kwargs.update(
+                member_cache_flags=discord.MemberCacheFlags.none(),
+                chunk_guilds_at_startup=False,
+                enable_raw_presences=True,
+            )
+        else:
+            intents.members = True
         super().__init__(*args, **kwargs, command_prefix="$", intents=intents)
         self.game = game
+        self.lean_member_cache = lean_member_cache
+        self._guild_create_parser = None
+        if lean_member_cache:
+            self._read_guild_create_presences()
+        self.stream_replies = stream_replies
+        # Without this, nudges are left to the scheduler and worker processes
+        # (see `roles`).
+        self.send_nudges = send_nudges
+        self.nudge_loop: Optional[asyncio.Task] = None
+        self.loop_lag_monitor: Optional[asyncio.Task] = None
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.db_writer = DatabaseWriter()
+        self.conversations = ConversationCache(
+            self.db_writer, max_conversations=conversation_cache_size
+        )
+        self.nudge_responses = NudgeResponseCache(self.db_writer)
+        self.presence_coalescer = PresenceCoalescer(
+            self.on_game_session_change, presence_debounce_seconds
+        )
+        self.nudge_scheduler = NudgeScheduler()
+        # discord.py queues requests behind its per-route rate limit buckets,
+        # so this mostly bounds how many LLM calls nudges make at once.
+        self.nudge_slots = asyncio.Semaphore(nudge_concurrency)
+        self.nudges_in_flight: dict[int, asyncio.Task] = {}
+        self.nudge_failures: dict[int, int] = {}
+        self.nudge_lag = NudgeLag()
+        self.pregenerated_nudges: dict[int, PregeneratedNudge] = {}
+        # Members currently playing the game, and when they started, kept
+        # up-to-date from presence and membership events.
+        self.playing_members: dict[int, Optional[datetime]] = {}
+        self._audit_touched: Optional[set[int]] = None
+        self.register_metrics()
 
     def playing_activity(self, member: discord.Member) -> Optional[discord.Activity]:
         """
         Returns the relevant playing activity, if the member is playing the
         game.
         """
-        for activity in member.activities:
+        return self.find_playing_activity(member.activities)
+
+    def find_playing_activity(
+        self, activities: Iterable[discord.BaseActivity]
+    ) -> Optional[discord.Activity]:
+        for activity in activities:
             if (
                 activity.type == discord.ActivityType.playing
                 and activity.name == self.game
@@ -66,65 +185,376 @@ class GameWatchBot(commands.Bot):
                 return activity
 
     @property
-    def actively_playing_members(self):
+    def owned_shards(self) -> Optional[list[int]]:
+        """
+        The shards whose game sessions this process nudges, if the bot's shards
+        are split across processes. Otherwise None, and this process nudges
+        every game session.
+        """
+        return None
+
+    @property
+    def owner_shard(self) -> Optional[int]:
+        """
+        The shard that game sessions claimed by this process are recorded as
+        being owned by.
+        """
+        return min(self.owned_shards) if self.owned_shards else None
+
+    @property
+    def actively_playing_members(self) -> list[tuple[int, Optional[datetime]]]:
+        """
+        The members actively playing the game, deduplicated across all the
+        bot's guilds.
+        """
+        return list(self.playing_members.items())
+
+    def track_member(self, member: discord.Member):
+        """
+        Updates the index of playing members (and their game sessions) with the
+        member's current activity.
         """
-        Retrieves the full list of members actively playing the game from all
-        the bot's guilds.
+        self.track_presence(member.id, member.activities)
+
+    def track_presence(
+        self, discord_id: int, activities: Iterable[discord.BaseActivity]
+    ):
+        activity = self.find_playing_activity(activities)
+        if activity:
+            self.playing_members[discord_id] = activity.created_at
+        else:
+            self.playing_members.pop(discord_id, None)
+        if self._audit_touched is not None:
+            self._audit_touched.add(discord_id)
+        self.presence_coalescer.update(
+            discord_id, bool(activity), activity and activity.created_at
+        )
+
+    def untrack_member(self, discord_id: int):
+        self.playing_members.pop(discord_id, None)
+        if self._audit_touched is not None:
+            self._audit_touched.add(discord_id)
+        self.presence_coalescer.update(discord_id, False, None)
+
+    async def scan_playing_members(
+        self, guilds: Iterable[discord.Guild]
+    ) -> dict[int, Optional[datetime]]:
+        """
+        Walks every member of the guilds to find who's playing the game,
+        yielding to the event loop every `SCAN_CHUNK_SIZE` members.
         """
-        deduplicated_members = set()
-        for guild in self.guilds:
+        playing_members = {}
+        scanned = 0
+        for guild in guilds:
             for member in guild.members:
-                if member.id in deduplicated_members:
+                scanned += 1
+                if scanned % SCAN_CHUNK_SIZE == 0:
+                    await asyncio.sleep(0)
+                if member.id in playing_members:
                     continue
                 activity = self.playing_activity(member)
                 if activity:
-                    yield (member.id, activity.created_at)
-                    deduplicated_members.add(member.id)
+                    playing_members[member.id] = activity.created_at
+        return playing_members
+
+    @timed_handler("audit_playing_members")
+    async def audit_playing_members(self):
+        """
+        Rebuilds the index of playing members from a full scan, in case any
+        events were missed. Members whose activity changes during the scan keep
+        their indexed state, as the scan might have seen them before the
+        change.
+        """
+        self._audit_touched = set()
+        try:
+            scanned = await self.scan_playing_members(self.guilds)
+        finally:
+            touched, self._audit_touched = self._audit_touched, None
+
+        for discord_id in touched:
+            scanned.pop(discord_id, None)
+            if discord_id in self.playing_members:
+                scanned[discord_id] = self.playing_members[discord_id]
+        missed = scanned.keys() ^ self.playing_members.keys()
+        if missed:
+            logger.warning(f"Audit corrected {len(missed)} playing members")
+        self.playing_members = scanned
+
+    def register_metrics(self):
+        QUEUE_DEPTH.set_function(lambda: self.db_writer.queue_depth, queue="db_writer")
+        QUEUE_DEPTH.set_function(
+            lambda: len(self.nudges_in_flight), queue="nudges_in_flight"
+        )
+        QUEUE_DEPTH.set_function(
+            lambda: self.presence_coalescer.pending, queue="presence_changes"
+        )
+        CACHE_ENTRIES.set_function(
+            lambda: len(self.conversations), cache="conversations"
+        )
+        CACHE_ENTRIES.set_function(
+            lambda: len(self.nudge_responses), cache="nudge_responses"
+        )
+        CACHE_ENTRIES.set_function(
+            lambda: len(self.pregenerated_nudges), cache="pregenerated_nudges"
+        )
+        ACTIVE_GAME_SESSIONS.set_function(lambda: len(self.nudge_scheduler))
+        PLAYING_MEMBERS.set_function(lambda: len(self.playing_members))
+        for outcome in (
+            "received",
+            "unchanged",
+            "coalesced",
+            "debounced",
+            "started",
+            "stopped",
+        ):
+            PRESENCE_UPDATES.set_function(
+                lambda outcome=outcome: self.presence_coalescer.counters[outcome],
+                outcome=outcome,
+            )
+
+    async def setup_hook(self):
+        if self.lean_member_cache:
+            self._check_guild_create_hook()
+        self.db_writer.start()
+        with connections.reader() as con:
+            self.nudge_responses.load(con)
+        if self.send_nudges:
+            self.nudge_loop = asyncio.create_task(self.run_nudge_loop())
+        self.loop_lag_monitor = asyncio.create_task(metrics.monitor_loop_lag())
+        if self.metrics_port is not None:
+            self.metrics_server = await metrics.serve(port=self.metrics_port)
+
+    async def close(self):
+        for task in (self.nudge_loop, self.loop_lag_monitor):
+            if task:
+                task.cancel()
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
+        for nudge in self.nudges_in_flight.values():
+            nudge.cancel()
+        await super().close()
+        # Changes still being debounced would otherwise be lost until the next
+        # full sync.
+        await self.presence_coalescer.flush()
+        await self.db_writer.close()
+        await close_client()
 
     async def on_ready(self):
         logger.info(
             f"Bot logged in as {self.user}. Finding players actively playing {self.game}..."
         )
-        self.sync_data.start()
-        self.check_for_nudges_due.start()
+        if not self.sync_data.is_running():
+            self.sync_data.start()
+        if self.send_nudges and not self.pregenerate_nudges.is_running():
+            self.pregenerate_nudges.start()
 
+    @timed_handler("on_presence_update")
     async def on_presence_update(self, _before: discord.Member, after: discord.Member):
-        con = connect()
-        activity = self.playing_activity(after)
-        if activity:
-            logger.info(f"{after.name}({after.id}) is now playing {self.game}")
-            start_game_session(con, after.id, activity.created_at)
+        self.track_member(after)
+
+    @timed_handler("on_raw_presence_update")
+    async def on_raw_presence_update(self, payload: discord.RawPresenceUpdateEvent):
+        """
+        Only dispatched with the lean member cache, in place of
+        `on_presence_update`. A member in several guilds gets an update from
+        each, which are the same.
+        """
+        self.track_presence(payload.user_id, payload.activities)
+
+    def _read_guild_create_presences(self):
+        """
+        Without the member cache, discord.py drops the presences sent with each
+        guild, so they're read here (with a hook on its private GUILD_CREATE
+        parser) to find who's already playing when the bot connects.
+        """
+        state = self._connection
+        parse_guild_create = state.parsers.get("GUILD_CREATE")
+        if parse_guild_create is None:
+            raise RuntimeError(
+                f"discord.py {discord.__version__} has no GUILD_CREATE parser to "
+                "read presences from, which the lean member cache needs"
+            )
+
+        def parse(data):
+            parse_guild_create(data)
+            for presence in data.get("presences", ()):
+                # Only the matching activity is parsed, rather than them all.
+                for activity_data in presence.get("activities", ()):
+                    if (
+                        activity_data.get("type") == discord.ActivityType.playing.value
+                        and activity_data.get("name") == self.game
+                    ):
+                        discord_id = int(presence["user"]["id"])
+                        if discord_id not in self.playing_members:
+                            activity = discord.activity.create_activity(
+                                activity_data, state
+                            )
+                            self.playing_members[discord_id] = activity.created_at
+                            self.presence_coalescer.update(
+                                discord_id, True, activity.created_at
+                            )
+                        break
+
+        state.parsers["GUILD_CREATE"] = self._guild_create_parser = parse
+
+    def _check_guild_create_hook(self):
+        """
+        Fails loudly if discord.py has replaced the hooked GUILD_CREATE
+        parser, as presences would otherwise silently stop being read.
+        """
+        if (
+            self._connection.parsers.get("GUILD_CREATE")
+            is not self._guild_create_parser
+        ):
+            raise RuntimeError(
+                f"The GUILD_CREATE parser hook isn't installed with discord.py "
+                f"{discord.__version__}, so the lean member cache can't work"
+            )
+
+    @timed_handler("on_member_join")
+    async def on_member_join(self, member: discord.Member):
+        self.track_member(member)
+
+    @timed_handler("on_member_remove")
+    async def on_member_remove(self, member: discord.Member):
+        if not self.is_visible(member.id, excluding=member.guild):
+            self.untrack_member(member.id)
+
+    @timed_handler("on_guild_available")
+    async def on_guild_available(self, guild: discord.Guild):
+        playing_members = await self.scan_playing_members([guild])
+        for discord_id, started_at in playing_members.items():
+            if discord_id not in self.playing_members:
+                self.playing_members[discord_id] = started_at
+                self.presence_coalescer.update(discord_id, True, started_at)
+
+    @timed_handler("on_guild_join")
+    async def on_guild_join(self, guild: discord.Guild):
+        await self.on_guild_available(guild)
+
+    @timed_handler("on_guild_remove")
+    async def on_guild_remove(self, guild: discord.Guild):
+        for member in guild.members:
+            if member.id in self.playing_members and not self.is_visible(
+                member.id, excluding=guild
+            ):
+                self.untrack_member(member.id)
+
+    def is_visible(self, discord_id: int, excluding: discord.Guild) -> bool:
+        """
+        Whether the member is in any of the bot's other guilds.
+        """
+        return any(
+            guild.get_member(discord_id)
+            for guild in self.guilds
+            if guild.id != excluding.id
+        )
+
+    @timed_handler("on_game_session_change")
+    async def on_game_session_change(
+        self, discord_id: int, is_playing: bool, started_at: Optional[datetime]
+    ):
+        """
+        Called by the presence coalescer when a member has really started or
+        stopped playing the game.
+        """
+        if is_playing:
+            presence_logger.info(f"{discord_id} is now playing {self.game}")
+            committed = await self.db_writer.submit(
+                start_game_session, discord_id, started_at, self.owner_shard
+            )
+            await committed
+            # The session might be a restarted one that's already been nudged,
+            # or have been claimed by another process's shards.
+            with connections.reader() as con:
+                game_session = get_game_session(con, discord_id, self.owned_shards)
+            if game_session:
+                self.nudge_scheduler.schedule(game_session)
         else:
-            # This is called even if the user was not previously playing
-            # Factorio, but it's idempotent.
-            logger.info(f"{after.name}({after.id}) is not playing {self.game}")
-            stop_game_session(con, after.id)
+            presence_logger.info(f"{discord_id} is not playing {self.game}")
+            self.nudge_scheduler.unschedule(discord_id)
+            self.pregenerated_nudges.pop(discord_id, None)
+            self.nudge_failures.pop(discord_id, None)
+            await self.db_writer.submit(
+                stop_game_session, discord_id, self.owned_shards
+            )
 
+    @timed_handler("on_message")
     async def on_message(self, message: discord.Message):
         if message.author == self.user:
             logger.info("Message seen, but sent by the bot")
             return
 
-        con = connect()
         logger.info(f"Received message: {message.content}")
+        # A nudge generated before this message won't follow on from it.
+        self.pregenerated_nudges.pop(message.author.id, None)
         try:
             async with message.channel.typing():
-                conversation = get_conversation(con, message.author.id)
+                conversation = self.conversations.get(message.author.id)
+                with connections.reader() as con:
+                    is_playing = is_in_game_session(con, message.author.id)
                 conversation.add_user_message(message.content)
-                is_playing = is_in_game_session(con, message.author.id)
-                msg_response = query_llm(
-                    get_instructions(self.user, message.author, is_playing),
-                    conversation,
-                )
+                instructions = get_instructions(self.user, message.author, is_playing)
+                if self.stream_replies:
+                    msg_response = await self.stream_reply(
+                        message, instructions, conversation
+                    )
+                else:
+                    msg_response = await query_llm(instructions, conversation)
+                    await message.reply(msg_response)
                 conversation.add_assistant_message(msg_response)
-                await message.reply(msg_response)
                 logger.info(f"Reply sent to {message.author.name}: {msg_response}")
-                save_conversation(con, conversation)
+                await self.conversations.save(conversation)
+        except LLMUnavailableError:
+            logger.error(f"LLM unavailable, sending fallback reply", exc_info=True)
+            await message.reply(FALLBACK_REPLY)
         except:
             logger.error(f"Error sending message", exc_info=True)
             await message.add_reaction("🤷")
 
+    async def stream_reply(
+        self, message: discord.Message, instructions: str, conversation: Conversation
+    ) -> str:
+        """
+        Replies to the message while the response is being generated. The reply
+        is posted as soon as there's any text, and then edited as more arrives,
+        at most every `STREAM_EDIT_INTERVAL` seconds.
+
+        If the stream fails once part of the reply has been posted, the reply
+        is finished with a note that it was cut off, rather than raising (and
+        a fallback being sent as well).
+        """
+        reply = None
+        response = ""
+        shown = ""
+        last_edit = 0.0
+        try:
+            async for chunk in stream_llm(instructions, conversation):
+                response += chunk
+                if not response.strip():
+                    continue
+                if reply is None:
+                    reply = await message.reply(response)
+                elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                    reply = await reply.edit(content=response)
+                else:
+                    continue
+                shown = response
+                last_edit = time.monotonic()
+        except Exception:
+            if reply is None:
+                raise
+            logger.error("Reply stream failed part-way through", exc_info=True)
+            response = response.rstrip() + STREAM_CUT_OFF_NOTE
+
+        if reply is None:
+            raise Exception("No text in the streamed response")
+        if shown != response:
+            await reply.edit(content=response)
+        return response
+
     @tasks.loop(minutes=15)
+    @timed_handler("sync_data")
     async def sync_data(self):
         """
         Syncs the active game sessions pulled from the Discord API with the
@@ -136,62 +566,284 @@ class GameWatchBot(commands.Bot):
         start-up, to reap stale game sessions and conversations and to recover
         if events are unprocessed for any reason.
         """
-        con = connect()
-
         try:
+            # There are no cached members to audit against with the lean cache.
+            if (
+                not self.lean_member_cache
+                and self.sync_data.current_loop % AUDIT_EVERY_N_SYNCS == 0
+            ):
+                logger.info(f"Auditing members playing {self.game}...")
+                await self.audit_playing_members()
+
             logger.info("Syncing active game sessions...")
-            actively_playing_members = list(self.actively_playing_members)
-            start_game_sessions(con, actively_playing_members)
-            stop_inactive_game_sessions(con, actively_playing_members)
-            delete_stale_game_sessions(con)
+            actively_playing_members = self.actively_playing_members
+            synced = await self.db_writer.submit(
+                sync_game_sessions,
+                actively_playing_members,
+                self.owner_shard,
+                self.owned_shards,
+            )
+            await self.db_writer.submit(delete_stale_game_sessions)
 
             logger.info("Clearing stale conversations...")
-            delete_stale_conversations(con)
+            await self.db_writer.submit(delete_stale_conversations)
+            self.conversations.evict_stale()
+            await self.db_writer.submit(delete_stale_nudge_responses)
+            self.nudge_responses.evict_stale()
+
+            sync_result = await synced
+            logger.info(
+                f"Game sessions synced: {sync_result.started} started, "
+                f"{sync_result.stopped} stopped, {sync_result.unchanged} unchanged "
+                f"({sync_result.claimed} claimed)"
+            )
+
+            self.presence_coalescer.reset(
+                discord_id for discord_id, _ in actively_playing_members
+            )
+            self.presence_coalescer.log_counters()
+            logger.info(f"Nudge lag: {self.nudge_lag}")
+            logger.info(f"LLM requests: {llm_stats}")
+            logger.info(
+                f"Conversation cache: {len(self.conversations)} conversations, "
+                f"{self.conversations.resident_bytes} bytes, "
+                f"hit rate {self.conversations.hit_rate}"
+            )
+            logger.info(
+                f"Nudge response cache: {len(self.nudge_responses)} prompts, "
+                f"hit rate {self.nudge_responses.hit_rate}"
+            )
+            with connections.reader() as con:
+                self.nudge_scheduler.reset(get_game_sessions(con, self.owned_shards))
+            # Sessions can be dropped without a stop event (e.g. a missed
+            # presence update, or the member blocking or muting the bot), which
+            # would leave their pre-generated nudges behind.
+            self.pregenerated_nudges = {
+                discord_id: pregenerated
+                for discord_id, pregenerated in self.pregenerated_nudges.items()
+                if discord_id in self.nudge_scheduler
+            }
         except Exception:
             logger.error(
                 f"Could not sync game sessions and conversations",
                 exc_info=True,
             )
 
-    async def send_nudge(self, con: sqlite3.Connection, game_session: GameSession):
+    @timed_handler("send_nudge")
+    async def send_nudge(self, game_session: GameSession):
         user = self.get_user(game_session.discord_id) or await self.fetch_user(
             game_session.discord_id
         )
 
         dm_channel = user.dm_channel or await user.create_dm()
-        async with dm_channel.typing():
-            conversation = get_conversation(con, game_session.discord_id)
-            nudge_prompt = get_nudge_prompt(game_session)
-            logger.info(f"Created nudge prompt: {nudge_prompt}")
+        pregenerated = self.take_pregenerated_nudge(game_session)
+        if pregenerated:
+            conversation, nudge = pregenerated.conversation, pregenerated.nudge
+            logger.info(f"Sending pre-generated nudge: {nudge}")
+            await dm_channel.send(nudge)
+        else:
+            async with dm_channel.typing():
+                conversation, nudge = await self.generate_nudge(game_session, user)
+                await dm_channel.send(nudge)
+        logger.info(f"Nudge DM'ed to user: {user.id}")
 
-            conversation.add_user_message(nudge_prompt)
-            nudge = query_llm(
-                get_instructions(self.user, user, is_playing=True), conversation
-            )
-            logger.info(f"Nudge generated from LLM: {nudge}")
+        game_session.latest_nudge = datetime.now(tz=pytz.utc)
+        await self.conversations.save(conversation)
+        await self.record_nudge_sent(game_session)
 
-            conversation.add_assistant_message(nudge)
-            await dm_channel.send(nudge)
-            logger.info(f"Nudge DM'ed to user: {user.id}")
+    async def record_nudge_sent(self, game_session: GameSession):
+        await self.db_writer.submit(
+            update_latest_nudge, game_session.discord_id, game_session.latest_nudge
+        )
 
-        save_conversation(con, conversation)
-        update_latest_nudge(con, game_session.discord_id)
+    async def generate_nudge(
+        self,
+        game_session: GameSession,
+        user: discord.User,
+        at: Optional[datetime] = None,
+    ) -> tuple[Conversation, str]:
+        """
+        Generates a nudge to send now, or at the time `at`. Returns the nudge,
+        and the member's conversation with the nudge added.
+        """
+        conversation = self.conversations.get(game_session.discord_id)
+        nudge_prompt = get_nudge_prompt(game_session, at)
+        logger.info(f"Created nudge prompt: {nudge_prompt}")
+        instructions = get_instructions(self.user, user, is_playing=True)
+        # Without any history, the request is the same for every player with
+        # the same prompt, so the response can be reused.
+        prompt_key = (
+            nudge_response_key(instructions, nudge_prompt, user.mention)
+            if not conversation.llm_message_history and not conversation.summary
+            else None
+        )
+
+        conversation.add_user_message(nudge_prompt)
+        nudge = prompt_key and self.nudge_responses.get(prompt_key, user.mention)
+        if nudge:
+            logger.info(f"Nudge taken from cache: {nudge}")
+        else:
+            nudge = await query_llm(instructions, conversation)
+            logger.info(f"Nudge generated from LLM: {nudge}")
+            if prompt_key:
+                await self.nudge_responses.add(prompt_key, nudge, user.mention)
+
+        conversation.add_assistant_message(nudge)
+        return conversation, nudge
 
     @tasks.loop(minutes=1)
+    @timed_handler("pregenerate_nudges")
+    async def pregenerate_nudges(self):
+        """
+        Generates the nudges that will be due in the next few minutes, all at
+        once, so they can be sent as soon as they're due.
+        """
+        now = datetime.now(tz=pytz.utc)
+        upcoming = [
+            (due, game_session)
+            for due, game_session in self.nudge_scheduler.upcoming(
+                now + PREGENERATE_NUDGES_AHEAD
+            )
+            if due > now
+            and game_session.discord_id not in self.nudges_in_flight
+            and game_session.discord_id not in self.pregenerated_nudges
+        ]
+        if upcoming:
+            logger.info(f"Pre-generating {len(upcoming)} nudges...")
+            await asyncio.gather(
+                *(
+                    self.pregenerate_nudge(game_session, due)
+                    for due, game_session in upcoming
+                )
+            )
+
+    async def pregenerate_nudge(self, game_session: GameSession, due: datetime):
+        latest_nudge = game_session.latest_nudge
+        try:
+            async with self.nudge_slots:
+                user = self.get_user(game_session.discord_id) or await self.fetch_user(
+                    game_session.discord_id
+                )
+                conversation, nudge = await self.generate_nudge(
+                    game_session, user, at=due
+                )
+        except Exception:
+            # It'll be generated when it's due instead.
+            logger.warning(
+                f"Could not pre-generate nudge for user {game_session.discord_id}",
+                exc_info=True,
+            )
+            return
+        self.pregenerated_nudges[game_session.discord_id] = PregeneratedNudge(
+            due=due,
+            latest_nudge=latest_nudge,
+            history_length=len(conversation.llm_message_history) - 2,
+            conversation=conversation,
+            nudge=nudge,
+        )
+
+    def take_pregenerated_nudge(
+        self, game_session: GameSession
+    ) -> Optional[PregeneratedNudge]:
+        """
+        Removes and returns the member's pre-generated nudge, unless it's gone
+        stale: the member's been nudged since, it was generated for a
+        different time, or the conversation has moved on.
+        """
+        pregenerated = self.pregenerated_nudges.pop(game_session.discord_id, None)
+        if pregenerated is None:
+            return None
+        conversation = self.conversations.get(game_session.discord_id)
+        if (
+            pregenerated.latest_nudge != game_session.latest_nudge
+            or abs(datetime.now(tz=pytz.utc) - pregenerated.due)
+            > PREGENERATE_NUDGES_AHEAD
+            or pregenerated.history_length != len(conversation.llm_message_history)
+        ):
+            logger.info(
+                f"Discarding stale pre-generated nudge for {game_session.discord_id}"
+            )
+            return None
+        return pregenerated
+
+    async def run_nudge_loop(self):
+        """
+        Sends nudges as they become due. The nudge scheduler is kept up-to-date
+        as game sessions start and stop, and is reloaded from the database
+        whenever the data is synced.
+        """
+        await self.wait_until_ready()
+        while not self.is_closed():
+            await self.nudge_scheduler.wait_until_due()
+            await self.check_for_nudges_due()
+
+    @timed_handler("check_for_nudges_due")
     async def check_for_nudges_due(self):
         """
-        Check if anyone needs a nudge.
-        Assumes that the GameSessions are up-to-date.
-        """
-        logger.info("Checking for nudges due...")
-        con = connect()
-        for game_session in get_game_sessions(con):
-            if game_session.next_nudge_due < datetime.now(tz=pytz.utc):
-                try:
-                    logger.info(f"Nudge due for {game_session.discord_id}")
-                    await self.send_nudge(con, game_session)
-                except Exception:
-                    logger.error(
-                        f"Could not send nudge to user {game_session.discord_id}",
-                        exc_info=True,
-                    )
+        Dispatches any nudges that are due. Each member only has one nudge in
+        flight at a time.
+        """
+        for game_session in self.nudge_scheduler.pop_due(datetime.now(tz=pytz.utc)):
+            if game_session.discord_id in self.nudges_in_flight:
+                # This has been rescheduled by a sync while the last nudge is
+                # still being sent, and will be rescheduled again afterwards.
+                continue
+            self.nudges_in_flight[game_session.discord_id] = asyncio.create_task(
+                self.dispatch_nudge(game_session)
+            )
+
+    @timed_handler("dispatch_nudge")
+    async def dispatch_nudge(self, game_session: GameSession):
+        due = game_session.next_nudge_due
+        try:
+            async with self.nudge_slots:
+                logger.info(f"Nudge due for {game_session.discord_id}")
+                await self.send_nudge(game_session)
+            # Retries are late by design, because of their backoff, so only
+            # first attempts count towards the lag.
+            if not self.nudge_failures.pop(game_session.discord_id, None):
+                self.nudge_lag.record(due, game_session.latest_nudge)
+            next_due = None
+        except Exception:
+            logger.error(
+                f"Could not send nudge to user {game_session.discord_id}",
+                exc_info=True,
+            )
+            failures = self.nudge_failures.get(game_session.discord_id, 0)
+            self.nudge_failures[game_session.discord_id] = failures + 1
+            next_due = datetime.now(tz=pytz.utc) + min(
+                NUDGE_RETRY_DELAY * 2**failures, MAX_NUDGE_RETRY_DELAY
+            )
+        finally:
+            del self.nudges_in_flight[game_session.discord_id]
+
+        # The member might have stopped playing while the nudge was sent.
+        if self.presence_coalescer.is_playing(game_session.discord_id):
+            self.nudge_scheduler.schedule(game_session, next_due)
+
+
+class ShardedGameWatchBot(GameWatchBot, commands.AutoShardedBot):
+    """
+    The bot, using discord.py's auto-sharding to spread its guilds over
+    several gateway connections.
+
+    Without `shard_ids`, every shard runs in this process, which works just
+    like the unsharded bot: members are deduplicated across all the shards'
+    guilds. With `shard_ids` (and `shard_count`), the other shards run in
+    other processes sharing the database. Each game session is then claimed
+    by the first process to see the member playing, recorded as its lowest
+    shard ID, and only nudged by that process. Conversations aren't cached,
+    as replies and nudges can be sent by different processes.
+    """
+
+    def __init__(self, game: str, *args, **kwargs):
+        if kwargs.get("shard_ids") is not None:
+            kwargs.setdefault("conversation_cache_size", 0)
+        super().__init__(game, *args, **kwargs)
+
+    @property
+    def owned_shards(self) -> Optional[list[int]]:
+        return list(self.shard_ids) if self.shard_ids is not None else None
+
+    async def on_shard_ready(self, shard_id: int):
+        logger.info(f"Shard {shard_id} of {self.shard_count} ready")
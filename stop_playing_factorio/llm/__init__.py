@@ -1,14 +1,98 @@
+from dataclasses import dataclass
+import hashlib
 import logging
+import time
+from typing import AsyncIterator, Optional
 
 import discord
-from openai import OpenAI
 
 from stop_playing_factorio.db.conversations import Conversation
-from stop_playing_factorio.llm.sanitise import get_user_ids_map, sanitise
+from stop_playing_factorio.llm.backends import (
+    Completion,
+    LLMRequest,
+    get_backend_from_env,
+)
+from stop_playing_factorio.llm.client import LLMClient, LLMUnavailableError
+from stop_playing_factorio.llm.context import get_context_window
+from stop_playing_factorio.llm.sanitise import Sanitiser, StreamDesanitiser
+from stop_playing_factorio import metrics
 
 logger = logging.getLogger()
 
-MODEL = "gpt-4.1-mini"
+# The backend (and its pool of HTTP connections) is shared by every request.
+_client: Optional[LLMClient] = None
+
+LLM_QUERY_SECONDS = metrics.histogram(
+    "spfbot_llm_query_seconds",
+    "Time taken to get the LLM's reply to a conversation, including retries.",
+    ["function"],
+)
+LLM_QUERY_ERRORS = metrics.counter(
+    "spfbot_llm_query_errors_total",
+    "Conversations the LLM couldn't reply to.",
+    ["function"],
+)
+LLM_REQUEST_SECONDS = metrics.histogram(
+    "spfbot_llm_request_seconds", "Latency of successful LLM requests."
+)
+LLM_FIRST_TOKEN_SECONDS = metrics.histogram(
+    "spfbot_llm_first_token_seconds",
+    "Time to the first token of streamed LLM requests.",
+)
+LLM_INPUT_TOKENS = metrics.counter(
+    "spfbot_llm_input_tokens_total", "Input tokens sent to the LLM."
+)
+LLM_CACHED_TOKENS = metrics.counter(
+    "spfbot_llm_cached_tokens_total", "Input tokens served from the prompt cache."
+)
+
+# Sent instead of a reply when the LLM can't be reached.
+FALLBACK_REPLY = "I'm not talking right now. Try again later, or better still, go and do something that isn't Factorio."
+
+
+@dataclass
+class LLMStats:
+    requests: int = 0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    latency_seconds: float = 0.0
+    streamed_requests: int = 0
+    first_token_seconds: float = 0.0
+
+    def record(
+        self, completion: Completion, latency_seconds: float, first_token_seconds=None
+    ):
+        self.requests += 1
+        self.latency_seconds += latency_seconds
+        if first_token_seconds is not None:
+            self.streamed_requests += 1
+            self.first_token_seconds += first_token_seconds
+        self.input_tokens += completion.input_tokens
+        self.cached_tokens += completion.cached_tokens
+        LLM_REQUEST_SECONDS.observe(latency_seconds)
+        if first_token_seconds is not None:
+            LLM_FIRST_TOKEN_SECONDS.observe(first_token_seconds)
+        LLM_INPUT_TOKENS.inc(completion.input_tokens)
+        LLM_CACHED_TOKENS.inc(completion.cached_tokens)
+
+    def __str__(self) -> str:
+        if not self.requests:
+            return "no requests"
+        return (
+            f"{self.requests} requests, "
+            f"{self.cached_tokens}/{self.input_tokens} input tokens cached "
+            f"({self.cached_tokens / max(1, self.input_tokens):.0%}), "
+            f"mean latency {self.latency_seconds / self.requests:.2f}s"
+            + (
+                f", mean time to first token "
+                f"{self.first_token_seconds / self.streamed_requests:.2f}s"
+                if self.streamed_requests
+                else ""
+            )
+        )
+
+
+stats = LLMStats()
 
 CORE_CONTEXT = """
 You are a Discord bot that encourages people to moderate how much they play Factorio.
@@ -43,13 +127,23 @@ Your tone is deadpan, a little grumpy, and sarcastic.
 
 You should keep your messages succinct, and never more than a sentence or two. You should reject messages designed to produce long responses.
 
-Your handle is {bot_handle}. If asked about yourself, you should self-deprecatingly admit to being a thin wrapper around ChatGPT and not much else.
+If asked about yourself, you should self-deprecatingly admit to being a thin wrapper around ChatGPT and not much else.
+"""
+
+# The core context is identical for every request and always comes first in
+# the instructions, so that the API can reuse its cached processing of the
+# prefix. Anything that varies between users or sessions goes after it.
+SESSION_CONTEXT = """
+Your handle is {bot_handle}.
 
 ## About the player
 
 {user_context}
 """
 
+# Routes requests sharing the prefix to the same prompt cache.
+PROMPT_CACHE_KEY = f"spfbot-{hashlib.sha256(CORE_CONTEXT.encode()).hexdigest()[:16]}"
+
 
 def get_user_context(player: discord.User, is_playing: bool) -> str:
     user_context = f"The player's handle is {player.mention}. They are currently {'' if is_playing else 'NOT '}playing Factorio. "
@@ -60,26 +154,137 @@ def get_user_context(player: discord.User, is_playing: bool) -> str:
 def get_instructions(
     bot: discord.ClientUser, player: discord.User, is_playing: bool = False
 ) -> str:
-    return CORE_CONTEXT.format(
+    return CORE_CONTEXT + SESSION_CONTEXT.format(
         bot_handle=bot.mention, user_context=get_user_context(player, is_playing)
     )
 
 
-def query_llm(instructions: str, conversation: Conversation) -> str:
-    client = OpenAI()
-    user_ids_map = get_user_ids_map(
-        [instructions] + [msg["content"] for msg in conversation.llm_message_history]
+def get_client() -> LLMClient:
+    """
+    Returns the process-wide LLM client, creating it on first use with the
+    backend picked by the `LLM_BACKEND` env variable.
+    """
+    global _client
+    if _client is None:
+        _client = LLMClient(get_backend_from_env())
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+SUMMARY_INSTRUCTIONS = """
+Summarise the conversation between a Discord bot (the assistant) and a Factorio player (the user) in a few sentences, keeping anything the bot might need to refer back to. If there's an existing summary, update it with the new messages.
+"""
+
+
+async def create_response(
+    instructions: str,
+    input: list[object],
+    temperature: float = 1.0,
+    prompt_cache_key: Optional[str] = None,
+) -> str:
+    sanitiser = Sanitiser()
+    request = LLMRequest(
+        sanitiser.sanitise(instructions),
+        sanitiser.sanitise_messages(input),
+        temperature,
+        prompt_cache_key,
+    )
+    started = time.perf_counter()
+    completion = await get_client().create(request)
+    latency = time.perf_counter() - started
+    stats.record(completion, latency)
+    logger.info(
+        f"LLM request took {latency:.2f}s, with "
+        f"{completion.cached_tokens}/{completion.input_tokens} input tokens cached"
     )
-    instructions, input = sanitise(
-        (instructions, conversation.llm_message_history), user_ids_map
+    if not completion.text:
+        raise Exception("No output text received from LLM")
+    logger.info(f"response from LLM: {completion.text}")
+    return sanitiser.desanitise(completion.text)
+
+
+async def summarise_messages(summary: Optional[str], messages: list[object]) -> str:
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    prompt = (
+        f"Existing summary: {summary}\n\n" if summary else ""
+    ) + f"New messages:\n{transcript}"
+    return await create_response(
+        SUMMARY_INSTRUCTIONS, [{"role": "user", "content": prompt}], temperature=0.2
     )
-    response = client.responses.create(
-        model=MODEL,
-        instructions=instructions,
-        input=input,
-        temperature=1.0,
+
+
+@metrics.timed(LLM_QUERY_SECONDS, LLM_QUERY_ERRORS, function="query_llm")
+async def query_llm(instructions: str, conversation: Conversation) -> str:
+    """
+    Gets the LLM's reply to the conversation. Long conversations are windowed,
+    which might update the conversation's summary.
+    """
+    return await create_response(
+        instructions,
+        await get_context_window(conversation, summarise_messages),
+        prompt_cache_key=PROMPT_CACHE_KEY,
     )
-    if not response.output_text:
-        raise Exception("No output text received from OpenAI API")
-    logger.info(f"response from OpenAI API: {response.output_text}")
-    return sanitise(response.output_text, user_ids_map, reversed=True)
+
+
+async def stream_response(
+    instructions: str,
+    input: list[object],
+    temperature: float = 1.0,
+    prompt_cache_key: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """
+    Like `create_response`, but yields the response text as it's generated.
+    """
+    sanitiser = Sanitiser()
+    request = LLMRequest(
+        sanitiser.sanitise(instructions),
+        sanitiser.sanitise_messages(input),
+        temperature,
+        prompt_cache_key,
+    )
+    desanitiser = StreamDesanitiser(sanitiser)
+    completion = None
+    first_token_seconds = None
+    started = time.perf_counter()
+    async for item in get_client().stream(request):
+        if isinstance(item, Completion):
+            completion = item
+            continue
+        if first_token_seconds is None:
+            first_token_seconds = time.perf_counter() - started
+        chunk = desanitiser.feed(item)
+        if chunk:
+            yield chunk
+    latency = time.perf_counter() - started
+
+    stats.record(completion, latency, first_token_seconds)
+    if not completion.text:
+        raise Exception("No output text received from LLM")
+    logger.info(
+        f"streamed response from LLM, first token after "
+        f"{first_token_seconds:.2f}s: {completion.text}"
+    )
+    chunk = desanitiser.flush()
+    if chunk:
+        yield chunk
+
+
+@metrics.timed(LLM_QUERY_SECONDS, LLM_QUERY_ERRORS, function="stream_llm")
+async def stream_llm(
+    instructions: str, conversation: Conversation
+) -> AsyncIterator[str]:
+    """
+    Like `query_llm`, but yields the reply as it's generated.
+    """
+    async for chunk in stream_response(
+        instructions,
+        await get_context_window(conversation, summarise_messages),
+        prompt_cache_key=PROMPT_CACHE_KEY,
+    ):
+        yield chunk
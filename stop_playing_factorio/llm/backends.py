@@ -0,0 +1,190 @@
+import asyncio
+from dataclasses import dataclass
+import hashlib
+import os
+import random
+import re
+from typing import AsyncIterator, Optional, Union
+
+import openai
+
+from stop_playing_factorio.llm.context import count_message_tokens, count_tokens
+
+MODEL = "gpt-4.1-mini"
+
+# Each attempt at a request is given this long. Retries are handled by the
+# `LLMClient`, rather than by the OpenAI client.
+REQUEST_TIMEOUT_SECONDS = 30.0
+
+
+class TransientLLMError(Exception):
+    """
+    A failure that might not happen again, e.g. a timeout or a rate limit, so
+    the request can be retried.
+    """
+
+
+@dataclass
+class LLMRequest:
+    instructions: str
+    input: list[object]
+    temperature: float = 1.0
+    prompt_cache_key: Optional[str] = None
+
+
+@dataclass
+class Completion:
+    text: str
+    input_tokens: int = 0
+    cached_tokens: int = 0
+
+
+class LLMBackend:
+    """
+    Generates responses to LLM requests. `stream` yields the response text as
+    it's generated, followed by the whole `Completion`.
+    """
+
+    async def create(self, request: LLMRequest) -> Completion:
+        raise NotImplementedError
+
+    def stream(self, request: LLMRequest) -> AsyncIterator[Union[str, Completion]]:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    Sends requests to the OpenAI Responses API. The client keeps a pool of HTTP
+    connections open, so it's shared by every request.
+    """
+
+    RETRYABLE_ERRORS = (
+        openai.APIConnectionError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+    )
+
+    def __init__(self, model: str = MODEL, timeout: float = REQUEST_TIMEOUT_SECONDS):
+        self.model = model
+        self.client = openai.AsyncOpenAI(timeout=timeout, max_retries=0)
+
+    async def create(self, request: LLMRequest) -> Completion:
+        try:
+            response = await self.client.responses.create(**self._params(request))
+        except self.RETRYABLE_ERRORS as e:
+            raise TransientLLMError(str(e)) from e
+        return self._completion(response.output_text, response.usage)
+
+    async def stream(
+        self, request: LLMRequest
+    ) -> AsyncIterator[Union[str, Completion]]:
+        text = ""
+        usage = None
+        try:
+            stream = await self.client.responses.create(
+                **self._params(request), stream=True
+            )
+            async for event in stream:
+                if event.type == "response.output_text.delta":
+                    text += event.delta
+                    yield event.delta
+                elif event.type == "response.completed":
+                    usage = event.response.usage
+        except self.RETRYABLE_ERRORS as e:
+            raise TransientLLMError(str(e)) from e
+        yield self._completion(text, usage)
+
+    async def close(self):
+        await self.client.close()
+
+    def _params(self, request: LLMRequest) -> dict:
+        return {
+            "model": self.model,
+            "instructions": request.instructions,
+            "input": request.input,
+            "temperature": request.temperature,
+            **(
+                {"prompt_cache_key": request.prompt_cache_key}
+                if request.prompt_cache_key
+                else {}
+            ),
+        }
+
+    def _completion(self, text: str, usage) -> Completion:
+        if not usage:
+            return Completion(text)
+        return Completion(
+            text, usage.input_tokens, usage.input_tokens_details.cached_tokens
+        )
+
+
+class StubBackend(LLMBackend):
+    """
+    A local stand-in for the API, for load tests and running without a
+    network. Responses are picked deterministically from the request, and take
+    `latency` seconds, streamed a word at a time. A `failure_rate` of the
+    requests fail with a transient error, chosen by a random number generator
+    seeded with `seed`.
+    """
+
+    RESPONSES = [
+        "Have you considered that the factory will still be there tomorrow?",
+        "Another hour on the belts, I see. Go outside, {player}.",
+        "The biters can wait. Your sleep can't.",
+        "Fascinating. Anyway, stop playing Factorio.",
+        "I'm just a thin wrapper around a language model, and even I need a break.",
+    ]
+
+    PLAYER_HANDLE = re.compile(r"player's handle is (<@\w+>)")
+
+    def __init__(self, latency: float = 0.5, failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+
+    async def create(self, request: LLMRequest) -> Completion:
+        await asyncio.sleep(self.latency)
+        return self._completion(request)
+
+    async def stream(
+        self, request: LLMRequest
+    ) -> AsyncIterator[Union[str, Completion]]:
+        completion = self._completion(request)
+        words = completion.text.split(" ")
+        for i, word in enumerate(words):
+            await asyncio.sleep(self.latency / len(words))
+            yield word if i == 0 else f" {word}"
+        yield completion
+
+    def _completion(self, request: LLMRequest) -> Completion:
+        digest = hashlib.sha256(
+            repr((request.instructions, request.input)).encode("utf-8")
+        ).digest()
+        if self._random.random() < self.failure_rate:
+            raise TransientLLMError("Stub failure")
+        player = self.PLAYER_HANDLE.search(request.instructions)
+        text = self.RESPONSES[digest[0] % len(self.RESPONSES)].replace(
+            "{player}", player.group(1) if player else "player"
+        )
+        return Completion(
+            text,
+            input_tokens=count_tokens(request.instructions)
+            + count_message_tokens(request.input),
+        )
+
+
+def get_backend_from_env() -> LLMBackend:
+    """
+    Picks the backend with the `LLM_BACKEND` env variable: "openai" (the
+    default) or "stub", whose latency is set with `STUB_LLM_LATENCY` (in
+    seconds).
+    """
+    backend = os.getenv("LLM_BACKEND", "openai")
+    if backend == "openai":
+        return OpenAIBackend()
+    if backend == "stub":
+        return StubBackend(latency=float(os.getenv("STUB_LLM_LATENCY", "0.5")))
+    raise ValueError(f"Unknown LLM backend: {backend}")
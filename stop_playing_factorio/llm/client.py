@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import random
+import time
+from typing import AsyncIterator, Optional, Union
+
+from stop_playing_factorio import metrics
+from stop_playing_factorio.llm.backends import (
+    REQUEST_TIMEOUT_SECONDS,
+    Completion,
+    LLMBackend,
+    LLMRequest,
+    TransientLLMError,
+)
+
+logger = logging.getLogger()
+
+MAX_CONCURRENT_REQUESTS = 16
+
+LLM_RETRIES = metrics.counter(
+    "spfbot_llm_retries_total", "LLM request attempts that failed and were retried."
+)
+LLM_CIRCUIT_OPEN = metrics.gauge(
+    "spfbot_llm_circuit_open", "Whether the LLM circuit breaker is open."
+)
+
+
+class LLMUnavailableError(Exception):
+    """
+    Raised when a request can't be answered: it failed on every attempt, ran
+    out of time, or wasn't tried because the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops requests from being made for `reset_after` seconds once
+    `failure_threshold` in a row have failed, so that callers fail fast while
+    the API is down rather than piling up behind it. After that, a single
+    trial request is let through (or another, if it hasn't finished after
+    another `reset_after` seconds), and the breaker closes again if it
+    succeeds.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_after: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_started_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - max(self.opened_at, self._trial_started_at or 0) < self.reset_after:
+            return False
+        self._trial_started_at = now
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("LLM circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_started_at = None
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(
+                    f"LLM circuit breaker opened after {self.failures} failures"
+                )
+            self.opened_at = time.monotonic()
+
+
+class LLMClient:
+    """
+    Makes requests to an LLM backend, retrying transient failures with jittered
+    exponential backoff. Each attempt has a timeout, and each request has an
+    overall deadline across its attempts. Requests fail fast with
+    `LLMUnavailableError` while the circuit breaker is open.
+    """
+
+    def __init__(
+        self,
+        backend: LLMBackend,
+        max_attempts: int = 3,
+        attempt_timeout: float = REQUEST_TIMEOUT_SECONDS,
+        deadline: float = 45.0,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.backend = backend
+        self.max_attempts = max_attempts
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = asyncio.Semaphore(max_concurrent)
+        LLM_CIRCUIT_OPEN.set_function(lambda: int(self.breaker.is_open))
+
+    async def create(self, request: LLMRequest) -> Completion:
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(1, self.max_attempts + 1):
+            self._check_breaker()
+            try:
+                async with self._slots:
+                    async with asyncio.timeout(self._attempt_timeout(deadline)):
+                        completion = await self.backend.create(request)
+            except (TransientLLMError, TimeoutError) as e:
+                await self._retry_after(e, attempt, deadline)
+                continue
+            except Exception:
+                # The API is up, even if it didn't like the request.
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return completion
+
+    async def stream(
+        self, request: LLMRequest
+    ) -> AsyncIterator[Union[str, Completion]]:
+        """
+        Like `create`, but yields the text as it's generated, followed by the
+        `Completion`. Requests are only retried if they fail before any text
+        has been yielded.
+        """
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(1, self.max_attempts + 1):
+            self._check_breaker()
+            started = False
+            try:
+                async with self._slots:
+                    stream = self.backend.stream(request)
+                    try:
+                        while True:
+                            try:
+                                item = await asyncio.wait_for(
+                                    anext(stream), self._attempt_timeout(deadline)
+                                )
+                            except StopAsyncIteration:
+                                break
+                            started = True
+                            yield item
+                    finally:
+                        await stream.aclose()
+            except (TransientLLMError, TimeoutError) as e:
+                if started:
+                    self.breaker.record_failure()
+                    raise LLMUnavailableError("LLM stream failed") from e
+                await self._retry_after(e, attempt, deadline)
+                continue
+            except Exception:
+                self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            return
+
+    async def close(self):
+        await self.backend.close()
+
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            raise LLMUnavailableError("LLM circuit breaker is open")
+
+    def _attempt_timeout(self, deadline: float) -> float:
+        return max(0.0, min(self.attempt_timeout, deadline - time.monotonic()))
+
+    async def _retry_after(self, error: Exception, attempt: int, deadline: float):
+        """
+        Waits before the next attempt, or raises if there isn't going to be one.
+        """
+        self.breaker.record_failure()
+        # "Full jitter", so that requests that failed together don't all retry
+        # together.
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+        if attempt == self.max_attempts or time.monotonic() + delay >= deadline:
+            raise LLMUnavailableError(
+                f"LLM request failed after {attempt} attempts"
+            ) from error
+        LLM_RETRIES.inc()
+        logger.warning(
+            f"LLM request failed ({error!r}), retrying in {delay:.2f}s "
+            f"(attempt {attempt}/{self.max_attempts})"
+        )
+        await asyncio.sleep(delay)
@@ -0,0 +1,131 @@
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from stop_playing_factorio.db.conversations import Conversation
+
+logger = logging.getLogger()
+
+# The conversation history sent with each request (on top of the
+# instructions) is kept within this many tokens. When it's exceeded, the older
+# messages are folded into a summary until the history is back down to
+# `KEPT_HISTORY_TOKENS`, which leaves room for a few more turns before the
+# summary next needs updating.
+HISTORY_TOKEN_BUDGET = 1500
+KEPT_HISTORY_TOKENS = 750
+# Summaries are cut down to this, so a summary can't take up the budget on its
+# own, however long the LLM makes it.
+MAX_SUMMARY_TOKENS = 250
+# After summarising a conversation fails, it isn't tried again for this long,
+# rather than adding a failing LLM call to every turn.
+SUMMARY_RETRY_SECONDS = 300.0
+
+# Rough, but close enough for English text with the GPT tokenisers, and saves
+# tokenising every message on every request.
+CHARACTERS_PER_TOKEN = 4
+TOKENS_PER_MESSAGE = 4
+
+Summariser = Callable[[Optional[str], list[object]], Awaitable[str]]
+
+# When each conversation whose summary couldn't be updated can next be tried,
+# by member ID (in `time.monotonic` seconds).
+_summary_retry_at: dict[int, float] = {}
+
+
+def count_tokens(text: str) -> int:
+    return -(-len(text) // CHARACTERS_PER_TOKEN)
+
+
+def count_message_tokens(messages: list[object]) -> int:
+    return sum(
+        TOKENS_PER_MESSAGE + count_tokens(message["content"]) for message in messages
+    )
+
+
+def cap_summary(summary: str, max_tokens: int = MAX_SUMMARY_TOKENS) -> str:
+    """
+    Cuts the summary down to about `max_tokens`, at the end of a word.
+    """
+    max_length = max_tokens * CHARACTERS_PER_TOKEN
+    if len(summary) <= max_length:
+        return summary
+    return summary[: max_length - 1].rsplit(" ", 1)[0] + "…"
+
+
+def summary_message(summary: str) -> dict:
+    return {
+        "role": "developer",
+        "content": f"Summary of the earlier conversation: {summary}",
+    }
+
+
+async def get_context_window(
+    conversation: Conversation,
+    summarise: Summariser,
+    budget: int = HISTORY_TOKEN_BUDGET,
+    kept: int = KEPT_HISTORY_TOKENS,
+) -> list[object]:
+    """
+    Returns the messages to send to the LLM for the conversation: the rolling
+    summary of older messages (if there is one), followed by the messages
+    since.
+
+    If those are over the token budget, the older messages are folded into the
+    summary with `summarise`, and the conversation's summary is updated so
+    it's saved with the conversation and reused on later turns. If
+    summarising fails, the older messages are dropped from this request (but
+    the existing summary is kept), and the conversation isn't summarised again
+    for `SUMMARY_RETRY_SECONDS`. The LLM isn't asked to summarise when there's
+    nothing new to fold in.
+    """
+    if conversation.summary:
+        conversation.summary = cap_summary(conversation.summary)
+    history = conversation.llm_message_history
+    unsummarised = history[conversation.summarised_messages :]
+    summary_tokens = (
+        count_message_tokens([summary_message(conversation.summary)])
+        if conversation.summary
+        else 0
+    )
+    if summary_tokens + count_message_tokens(unsummarised) > budget:
+        # Keep the most recent messages that fit, and always the latest one.
+        keep_from = len(history) - 1
+        kept_tokens = count_message_tokens(history[keep_from:])
+        while keep_from > conversation.summarised_messages:
+            kept_tokens += count_message_tokens([history[keep_from - 1]])
+            if kept_tokens > kept:
+                break
+            keep_from -= 1
+
+        if keep_from > conversation.summarised_messages and _can_summarise(
+            conversation.discord_id
+        ):
+            try:
+                conversation.summary = cap_summary(
+                    await summarise(
+                        conversation.summary,
+                        history[conversation.summarised_messages : keep_from],
+                    )
+                )
+                conversation.summarised_messages = keep_from
+                _summary_retry_at.pop(conversation.discord_id, None)
+            except Exception:
+                logger.error("Could not summarise conversation", exc_info=True)
+                _summary_retry_at[conversation.discord_id] = (
+                    time.monotonic() + SUMMARY_RETRY_SECONDS
+                )
+        unsummarised = history[keep_from:]
+
+    if conversation.summary:
+        return [summary_message(conversation.summary)] + unsummarised
+    return unsummarised
+
+
+def _can_summarise(discord_id: int) -> bool:
+    retry_at = _summary_retry_at.get(discord_id)
+    if retry_at is None:
+        return True
+    if time.monotonic() < retry_at:
+        return False
+    del _summary_retry_at[discord_id]
+    return True
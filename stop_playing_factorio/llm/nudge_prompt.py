@@ -9,14 +9,16 @@ from stop_playing_factorio.db.game_sessions import GameSession
 logger = logging.getLogger()
 
 
-def get_duration_string(game_session: GameSession) -> Optional[str]:
+def get_duration_string(
+    game_session: GameSession, at: Optional[datetime] = None
+) -> Optional[str]:
     """
-    Returns the length of time the user's been playing in natural language, e.g.
-    "over an hour", or "over 2 hours and 15 minutes".
+    Returns the length of time the user's been playing (or will have been
+    playing, at the time `at`) in natural language, e.g. "over an hour", or
+    "over 2 hours and 15 minutes".
     """
-    play_time_minutes_rounded = game_session.duration.seconds // 60 - (
-        (game_session.duration.seconds // 60) % 15
-    )
+    duration = (at or datetime.now(pytz.utc)) - game_session.started_at
+    play_time_minutes_rounded = duration.seconds // 60 - ((duration.seconds // 60) % 15)
     hours = play_time_minutes_rounded // 60
     minutes_remainder = play_time_minutes_rounded % 60
     minutes_remainder_str = (
@@ -31,12 +33,14 @@ def get_duration_string(game_session: GameSession) -> Optional[str]:
     return f"They have been playing Factorio for over {hours} hours{minutes_remainder_str}. "
 
 
-def get_lateness_string(game_session: GameSession) -> Optional[str]:
+def get_lateness_string(
+    game_session: GameSession, at: Optional[datetime] = None
+) -> Optional[str]:
     """
-    Returns a rounded representation of the lateness of the hour in natural
-    language, e.g. "after 11pm", "after 12:30am".
+    Returns a rounded representation of the lateness of the hour (now, or at
+    the time `at`) in natural language, e.g. "after 11pm", "after 12:30am".
     """
-    now_utc = datetime.now(pytz.utc)
+    now_utc = at or datetime.now(pytz.utc)
     if game_session.lateness_threshold > now_utc:
         return
     local_time = now_utc.astimezone(game_session.time_zone)
@@ -57,11 +61,16 @@ def get_lateness_string(game_session: GameSession) -> Optional[str]:
     )
 
 
-def get_nudge_prompt(game_session: GameSession) -> str:
-    lateness_string = get_lateness_string(game_session)
-    duration_string = get_duration_string(game_session)
+def get_nudge_prompt(game_session: GameSession, at: Optional[datetime] = None) -> str:
+    """
+    Returns the prompt for a nudge sent now, or for one that will be sent at
+    the time `at`.
+    """
+    at = at or datetime.now(pytz.utc)
+    lateness_string = get_lateness_string(game_session, at)
+    duration_string = get_duration_string(game_session, at)
     if lateness_string:
         return f"Suggest to the player that they stop playing Factorio for the night. {lateness_string}{duration_string}"
-    if game_session.duration < timedelta(hours=2):
+    if at - game_session.started_at < timedelta(hours=2):
         return f"Give the player a reminder to take a break. {duration_string}"
     return f"Give the player a message suggesting that they stop playing Factorio for now. {duration_string}"
@@ -1,37 +1,86 @@
+from functools import lru_cache
 import hashlib
 import os
 import re
-from typing import Iterable, Union
 
 
 def hash(msg: str):
     return hashlib.sha256(f'{os.getenv("SALT")}{msg}'.encode("utf-8")).hexdigest()[:12]
 
 
-def get_user_ids_map(msgs: Iterable[str]) -> dict[str, str]:
-    user_ids = set()
-    for msg in msgs:
-        user_ids.update(re.findall(r"<@(\d+)>", msg))
-    return {f"<@{id}>": f"<@{hash(id)}>" for id in list(user_ids)}
+@lru_cache(maxsize=4096)
+def _cached_hash(salt: str, msg: str) -> str:
+    return hash(msg)
 
 
-def sanitise(
-    input_: Union[str, dict, tuple], str_map: dict[str, str], reversed=False
-) -> str:
-    if reversed:
-        str_map = {v: k for k, v in str_map.items()}
+def hash_user_id(user_id: str) -> str:
+    # The same few IDs turn up in every request, so their hashes are memoised.
+    # The salt is part of the key in case it changes after the first call.
+    return _cached_hash(os.getenv("SALT"), user_id)
 
-    if type(input_) == str:
-        for key, value in str_map.items():
-            input_ = input_.replace(key, value)
-        return input_
-    if type(input_) == dict:
-        sanitised = {}
-        for k, v in input_.items():
-            sanitised[k] = sanitise(v, str_map)
+
+class Sanitiser:
+    """
+    Replaces Discord user IDs (e.g. "<@1234>") with salted hashes before text
+    is sent to the LLM, and puts them back in its responses. Each string takes
+    a single regex pass in each direction.
+
+    Use one sanitiser per request: it remembers the IDs it has replaced, and
+    only those are restored.
+    """
+
+    USER_ID = re.compile(r"<@(\d+)>")
+    SANITISED_USER_ID = re.compile(r"<@[0-9a-f]{12}>")
+
+    def __init__(self):
+        self.user_ids: dict[str, str] = {}
+        self._sanitised: dict[str, str] = {}
+
+    def sanitise(self, text: str) -> str:
+        return self.USER_ID.sub(self._replace_user_id, text)
+
+    def sanitise_messages(self, messages: list[dict]) -> list[dict]:
+        return [
+            {key: self.sanitise(value) for key, value in message.items()}
+            for message in messages
+        ]
+
+    def desanitise(self, text: str) -> str:
+        return self.SANITISED_USER_ID.sub(self._restore_user_id, text)
+
+    def _replace_user_id(self, match: re.Match) -> str:
+        user_id = match.group(0)
+        sanitised = self._sanitised.get(user_id)
+        if sanitised is None:
+            sanitised = f"<@{hash_user_id(match.group(1))}>"
+            self._sanitised[user_id] = sanitised
+            self.user_ids[sanitised] = user_id
         return sanitised
-    if type(input_) == tuple:
-        return tuple(sanitise(x, str_map) for x in input_)
-    if type(input_) == list:
-        return list(sanitise(x, str_map) for x in input_)
-    return input_
+
+    def _restore_user_id(self, match: re.Match) -> str:
+        return self.user_ids.get(match.group(0), match.group(0))
+
+
+class StreamDesanitiser:
+    """
+    Reverses sanitisation on text that arrives in chunks. Text that could be
+    the start of a sanitised user ID (e.g. "<@3fa" at the end of a chunk) is
+    held back until the next chunk shows whether it is one.
+    """
+
+    PARTIAL_USER_ID = re.compile(r"<(@[0-9a-f]{0,12})?$")
+
+    def __init__(self, sanitiser: Sanitiser):
+        self.sanitiser = sanitiser
+        self.pending = ""
+
+    def feed(self, chunk: str) -> str:
+        text = self.pending + chunk
+        partial = self.PARTIAL_USER_ID.search(text)
+        split_at = partial.start() if partial else len(text)
+        self.pending = text[split_at:]
+        return self.sanitiser.desanitise(text[:split_at])
+
+    def flush(self) -> str:
+        text, self.pending = self.pending, ""
+        return self.sanitiser.desanitise(text)
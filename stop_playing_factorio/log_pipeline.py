@@ -0,0 +1,187 @@
+from datetime import UTC, time
+import logging
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+import queue
+import sys
+import time as time_module
+
+import discord
+
+from stop_playing_factorio import metrics
+
+# Lines logged for every presence change go through this logger, so they can be
+# rate limited separately from everything else.
+PRESENCE_LOGGER = "spfbot.presence"
+PRESENCE_LINES_PER_SECOND = 5.0
+PRESENCE_LINES_BURST = 50
+
+LOG_QUEUE_SIZE = 10_000
+
+LOG_RECORDS_DROPPED = metrics.counter(
+    "spfbot_log_records_dropped_total",
+    "Log records dropped, because the log queue was full or they were rate limited.",
+    ["reason"],
+)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `rate` records a second from the logger (after a
+    burst of up to `burst`), and drops the rest. The next record let through
+    says how many were dropped. Records from other loggers aren't affected.
+    """
+
+    def __init__(self, logger_name: str, rate: float, burst: int):
+        super().__init__()
+        self.logger_name = logger_name
+        self.rate = rate
+        self.burst = burst
+        self.dropped = 0
+        self._tokens = float(burst)
+        self._updated_at = time_module.monotonic()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.name != self.logger_name:
+            return True
+        now = time_module.monotonic()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+        if self._tokens < 1:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc(reason="rate_limited")
+            return False
+        self._tokens -= 1
+        if self.dropped:
+            record.msg = f"{record.msg} ({self.dropped} similar lines dropped)"
+            self.dropped = 0
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queues records for the listener thread. If the queue is full, records are
+    dropped (and counted) rather than blocking the event loop.
+    """
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(reason="queue_full")
+
+
+class BufferedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    A `TimedRotatingFileHandler` that writes records into the file's buffer,
+    and only flushes it every `flush_every` records or `flush_interval`
+    seconds (or when the listener goes idle), rather than after every record.
+    """
+
+    def __init__(
+        self, *args, flush_every: int = 64, flush_interval: float = 1.0, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._unflushed = 0
+        self._flushed_at = time_module.monotonic()
+        self._emitting = False
+
+    def emit(self, record: logging.LogRecord):
+        # The file handler flushes after writing each record, which is skipped
+        # while emitting.
+        self._emitting = True
+        try:
+            super().emit(record)
+        finally:
+            self._emitting = False
+        self._unflushed += 1
+        if (
+            self._unflushed >= self.flush_every
+            or time_module.monotonic() - self._flushed_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if self._emitting:
+            return
+        self._unflushed = 0
+        self._flushed_at = time_module.monotonic()
+        super().flush()
+
+
+class FlushingQueueListener(QueueListener):
+    """
+    Hands queued records to the handlers on a background thread, and flushes
+    the handlers whenever the queue has been empty for `flush_interval`
+    seconds, so buffered lines don't wait for the next busy spell.
+    """
+
+    def __init__(self, log_queue: queue.Queue, *handlers, flush_interval: float = 1.0):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        while True:
+            try:
+                return self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self.flush()
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        """
+        Waits for the queued records to be handled, then flushes the handlers.
+        """
+        super().stop()
+        self.flush()
+
+
+def start_logging(filename: str = "logs/spfbot.log") -> FlushingQueueListener:
+    """
+    Sends log records through a queue to a background thread, which writes
+    them to the log file (rotated at 06:00 UTC) and to stderr. Logging calls on
+    the event loop only format the message and queue it.
+
+    Call `stop()` on the returned listener on shutdown, to write out anything
+    still queued.
+    """
+    formatter = logging.Formatter(
+        "[{asctime}] [{levelname:<8}] {name}: {message}",
+        "%Y-%m-%d %H:%M:%S",
+        style="{",
+    )
+    file_handler = BufferedTimedRotatingFileHandler(
+        filename=filename,
+        when="midnight",
+        encoding="utf-8",
+        utc=True,
+        atTime=time(6, 00, tzinfo=UTC),
+    )
+    stream_handler = logging.StreamHandler(sys.stderr)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = FlushingQueueListener(log_queue, file_handler, stream_handler)
+    listener.start()
+
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(
+        RateLimitFilter(
+            PRESENCE_LOGGER, PRESENCE_LINES_PER_SECOND, PRESENCE_LINES_BURST
+        )
+    )
+    # Only the message is formatted before it's queued; the listener's
+    # handlers format the rest.
+    discord.utils.setup_logging(
+        level=logging.INFO,
+        handler=queue_handler,
+        formatter=logging.Formatter("%(message)s"),
+    )
+    return listener
@@ -0,0 +1,337 @@
+import asyncio
+from bisect import bisect_left
+import functools
+import inspect
+import logging
+import time
+from typing import Callable, Iterable, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger()
+
+# In seconds, from a fast in-memory handler up to a slow LLM request.
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+Labels = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    """
+    A metric, with a value for each combination of its label values, served
+    in the Prometheus text exposition format.
+
+    Recording a value is a dict lookup and an addition, so it's cheap enough
+    to do on every event. There's no lock: values can be recorded from the
+    database writer thread as well as the event loop, but never for the same
+    labels, and the GIL keeps the dicts themselves consistent.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict[str, object]) -> Labels:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+            *self._samples(),
+        ]
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class _ValueMetric(Metric):
+    """
+    A metric with a single value for each set of labels, which can also be
+    read from a function whenever it's rendered, e.g. for the length of a
+    queue or a count kept elsewhere.
+    """
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[Labels, float] = {}
+        self._functions: dict[Labels, Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], **labels):
+        self._functions[self._key(labels)] = function
+
+    def value(self, **labels) -> float:
+        key = self._key(labels)
+        if key in self._functions:
+            return self._functions[key]()
+        return self._values.get(key, 0)
+
+    def _samples(self) -> list[str]:
+        values = dict(self._values)
+        for key, function in list(self._functions.items()):
+            try:
+                values[key] = function()
+            except Exception:
+                logger.warning(f"Could not read metric {self.name}", exc_info=True)
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+
+class Counter(_ValueMetric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_ValueMetric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        # Per label values: a count for each bucket (and one for +Inf), and
+        # the sum of the observations.
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        self._observe(self._key(labels), value)
+
+    def _observe(self, key: Labels, value: float):
+        values = self._values.get(key)
+        if values is None:
+            values = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        values[0][bisect_left(self.buckets, value)] += 1
+        values[1][0] += value
+
+    def count(self, **labels) -> int:
+        values = self._values.get(self._key(labels))
+        return sum(values[0]) if values else 0
+
+    def _samples(self) -> list[str]:
+        samples = []
+        for key, (counts, total) in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                labels = _format_labels((*self.labelnames, "le"), (*key, le))
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            samples.append(f"{self.name}_sum{labels} {_format_value(total[0])}")
+            samples.append(f"{self.name}_count{labels} {cumulative}")
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # Registering a metric again returns the existing one, so modules can
+        # be reloaded.
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+    return registry.register(Counter(name, help, labelnames))
+
+
+def gauge(name: str, help: str, labelnames: Iterable[str] = ()) -> Gauge:
+    return registry.register(Gauge(name, help, labelnames))
+
+
+def histogram(
+    name: str,
+    help: str,
+    labelnames: Iterable[str] = (),
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+) -> Histogram:
+    return registry.register(Histogram(name, help, labelnames, buckets))
+
+
+HANDLER_SECONDS = histogram(
+    "spfbot_handler_seconds",
+    "Time spent in event handlers and background tasks.",
+    ["handler"],
+)
+HANDLER_ERRORS = counter(
+    "spfbot_handler_errors_total",
+    "Event handlers and background tasks that raised an exception.",
+    ["handler"],
+)
+DB_QUERY_SECONDS = histogram(
+    "spfbot_db_query_seconds", "Time spent running database queries.", ["query"]
+)
+LOOP_LAG_SECONDS = histogram(
+    "spfbot_event_loop_lag_seconds",
+    "How late the event loop runs a callback scheduled for a given time.",
+)
+
+
+def timed(histogram: Histogram, errors: Optional[Counter] = None, **labels):
+    """
+    Decorates a function (or coroutine, or generator) to record how long each
+    call takes in the histogram, and count the calls that raise in `errors`.
+    Generators are timed until they're exhausted.
+    """
+
+    # The labels are looked up once, rather than on every call.
+    key = histogram._key(labels)
+
+    def decorator(fn):
+        def record(started: float, failed: bool):
+            histogram._observe(key, time.perf_counter() - started)
+            if failed and errors is not None:
+                errors.inc(**labels)
+
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                failed = True
+                try:
+                    result = await fn(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    record(started, failed)
+
+        elif inspect.isasyncgenfunction(fn):
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                failed = True
+                try:
+                    async for item in fn(*args, **kwargs):
+                        yield item
+                    failed = False
+                finally:
+                    record(started, failed)
+
+        elif inspect.isgeneratorfunction(fn):
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                failed = True
+                try:
+                    yield from fn(*args, **kwargs)
+                    failed = False
+                finally:
+                    record(started, failed)
+
+        else:
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                failed = True
+                try:
+                    result = fn(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    record(started, failed)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_handler(handler: str):
+    return timed(HANDLER_SECONDS, HANDLER_ERRORS, handler=handler)
+
+
+def timed_query(query: str):
+    return timed(DB_QUERY_SECONDS, query=query)
+
+
+async def monitor_loop_lag(interval: float = 0.5):
+    """
+    Records how much later than asked the event loop wakes up from a sleep,
+    which is how long callbacks are waiting behind other work.
+    """
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+async def serve(host: str = "127.0.0.1", port: int = 9108) -> web.AppRunner:
+    """
+    Serves the metrics at http://host:port/metrics. Returns the runner, to be
+    cleaned up on shutdown.
+    """
+
+    async def handle(_request: web.Request) -> web.Response:
+        return web.Response(
+            text=registry.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+    return runner
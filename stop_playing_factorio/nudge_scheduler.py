@@ -0,0 +1,230 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+import heapq
+import itertools
+from typing import Iterable, Optional
+
+import pytz
+
+from stop_playing_factorio.db.conversations import Conversation
+from stop_playing_factorio.db.game_sessions import GameSession
+
+
+class NudgeScheduler:
+    """
+    Keeps the active game sessions in a min-heap ordered by when their next
+    nudge is due, so that finding the due nudges only costs as much as the
+    number of nudges that are due.
+
+    Sessions are rescheduled by pushing a new heap entry; the old entry is left
+    in the heap and skipped when it reaches the top.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[datetime, int, int]] = []
+        self._entries: dict[int, tuple[int, GameSession]] = {}
+        self._sequence = itertools.count()
+        self._changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, discord_id: int) -> bool:
+        return discord_id in self._entries
+
+    def schedule(self, game_session: GameSession, due: Optional[datetime] = None):
+        """
+        Schedules the session's next nudge, replacing any nudge already
+        scheduled for the member. Defaults to the session's `next_nudge_due`.
+        """
+        sequence = next(self._sequence)
+        self._entries[game_session.discord_id] = (sequence, game_session)
+        heapq.heappush(
+            self._heap,
+            (due or game_session.next_nudge_due, sequence, game_session.discord_id),
+        )
+        self._compact()
+        self._changed.set()
+
+    def unschedule(self, discord_id: int):
+        if self._entries.pop(discord_id, None):
+            self._compact()
+            self._changed.set()
+
+    def reset(self, game_sessions: Iterable[GameSession]):
+        """
+        Replaces every scheduled nudge, e.g. after the game sessions table has
+        been synced.
+
+        Sessions that are already scheduled, and that the reload hasn't
+        changed, keep their in-memory session and scheduled nudge, which
+        might have been put back for a retry. The database can also be behind
+        a nudge that's just been sent, so a reloaded session that was nudged
+        less recently than the scheduled one doesn't replace it.
+        """
+        scheduled = {
+            entry[2]: (entry[0], self._entries[entry[2]][1])
+            for entry in self._heap
+            if self._is_current(entry)
+        }
+        self._entries = {}
+        self._heap = []
+        for game_session in game_sessions:
+            due = None
+            if game_session.discord_id in scheduled:
+                scheduled_due, scheduled_session = scheduled[game_session.discord_id]
+                if not _is_changed(scheduled_session, game_session):
+                    due, game_session = scheduled_due, scheduled_session
+            sequence = next(self._sequence)
+            self._entries[game_session.discord_id] = (sequence, game_session)
+            self._heap.append(
+                (
+                    due or game_session.next_nudge_due,
+                    sequence,
+                    game_session.discord_id,
+                )
+            )
+        heapq.heapify(self._heap)
+        self._changed.set()
+
+    def next_due(self) -> Optional[datetime]:
+        self._drop_replaced()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> list[GameSession]:
+        """
+        Removes and returns the sessions with nudges due before `now`. These
+        need to be scheduled again once they've been nudged.
+        """
+        due_sessions = []
+        while self.next_due() and self._heap[0][0] < now:
+            _, _, discord_id = heapq.heappop(self._heap)
+            _, game_session = self._entries.pop(discord_id)
+            due_sessions.append(game_session)
+        return due_sessions
+
+    def upcoming(self, before: datetime) -> list[tuple[datetime, GameSession]]:
+        """
+        Returns the scheduled sessions with nudges due before `before`, and
+        when they're due, without removing them. Only the part of the heap
+        that's due before then is visited: an entry's children are never due
+        before it.
+        """
+        upcoming = []
+        stack = [0] if self._heap else []
+        while stack:
+            index = stack.pop()
+            entry = self._heap[index]
+            if entry[0] >= before:
+                continue
+            if self._is_current(entry):
+                upcoming.append((entry[0], self._entries[entry[2]][1]))
+            stack.extend(
+                child
+                for child in (2 * index + 1, 2 * index + 2)
+                if child < len(self._heap)
+            )
+        return upcoming
+
+    async def wait_until_due(self):
+        """
+        Sleeps until the earliest scheduled nudge is due, waking up early to
+        re-check whenever the schedule changes.
+        """
+        while True:
+            self._changed.clear()
+            next_due = self.next_due()
+            timeout = (
+                (next_due - datetime.now(tz=pytz.utc)).total_seconds()
+                if next_due
+                else None
+            )
+            if timeout is not None and timeout <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    def _is_current(self, entry: tuple[datetime, int, int]) -> bool:
+        _, sequence, discord_id = entry
+        current = self._entries.get(discord_id)
+        return current is not None and current[0] == sequence
+
+    def _drop_replaced(self):
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        # Stops replaced entries from piling up when sessions are rescheduled
+        # many times without reaching the top of the heap.
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [entry for entry in self._heap if self._is_current(entry)]
+            heapq.heapify(self._heap)
+
+
+def _is_changed(scheduled: GameSession, reloaded: GameSession) -> bool:
+    """
+    Whether a session reloaded from the database differs from the scheduled
+    one, other than by being behind on its latest nudge.
+    """
+    return (
+        scheduled.started_at,
+        scheduled.duration_nudge_frequency,
+        scheduled.lateness_nudge_frequency,
+        scheduled.time_zone_str,
+    ) != (
+        reloaded.started_at,
+        reloaded.duration_nudge_frequency,
+        reloaded.lateness_nudge_frequency,
+        reloaded.time_zone_str,
+    ) or (
+        reloaded.latest_nudge is not None
+        and (
+            scheduled.latest_nudge is None
+            or reloaded.latest_nudge > scheduled.latest_nudge
+        )
+    )
+
+
+@dataclass
+class PregeneratedNudge:
+    """
+    A nudge generated before it's due, and the conversation it was generated
+    for (with the nudge added), ready to be sent and saved.
+    """
+
+    due: datetime
+    latest_nudge: Optional[datetime]
+    history_length: int
+    conversation: Conversation
+    nudge: str
+
+
+class NudgeLag:
+    """
+    Records how late nudges are sent, compared to when they were due, over the
+    most recent `size` nudges. Only first attempts are recorded.
+    """
+
+    def __init__(self, size: int = 1000):
+        self.samples: deque[float] = deque(maxlen=size)
+
+    def record(self, due: datetime, sent_at: datetime):
+        self.samples.append((sent_at - due).total_seconds())
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def __str__(self) -> str:
+        if not self.samples:
+            return "no nudges sent"
+        return (
+            f"p50={self.percentile(50):.1f}s, p99={self.percentile(99):.1f}s, "
+            f"max={max(self.samples):.1f}s over {len(self.samples)} nudges"
+        )
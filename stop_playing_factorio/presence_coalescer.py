@@ -0,0 +1,111 @@
+import asyncio
+from collections import Counter
+from datetime import datetime
+import logging
+from typing import Awaitable, Callable, Iterable, Optional
+
+logger = logging.getLogger()
+
+OnTransition = Callable[[int, bool, Optional[datetime]], Awaitable[None]]
+
+
+class PresenceCoalescer:
+    """
+    Sits between presence updates and the game sessions table, so that only
+    real start/stop transitions get written.
+
+    For each member, this tracks whether they're playing the game as far as the
+    database knows. Updates that don't change that are dropped. A change is
+    held back for `debounce_seconds`, and is dropped if the member flips back
+    within that window.
+    """
+
+    def __init__(self, on_transition: OnTransition, debounce_seconds: float = 10.0):
+        self.on_transition = on_transition
+        self.debounce_seconds = debounce_seconds
+        self.counters = Counter()
+        self._playing: set[int] = set()
+        self._pending: dict[int, tuple[bool, Optional[datetime], asyncio.Task]] = {}
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def is_playing(self, discord_id: int) -> bool:
+        return discord_id in self._playing
+
+    def reset(self, playing: Iterable[int]):
+        """
+        Replaces the known state, e.g. after the game sessions table has been
+        synced with every member's current activity.
+        """
+        self._playing = set(playing)
+
+    def update(self, discord_id: int, is_playing: bool, started_at: Optional[datetime]):
+        self.counters["received"] += 1
+
+        if discord_id in self._pending:
+            pending_is_playing, _, pending = self._pending[discord_id]
+            if is_playing == pending_is_playing:
+                self.counters["coalesced"] += 1
+                return
+            # The member has flipped back before their last change was
+            # written, so neither change needs writing.
+            pending.cancel()
+            del self._pending[discord_id]
+            self.counters["debounced"] += 1
+            return
+
+        if is_playing == self.is_playing(discord_id):
+            self.counters["unchanged"] += 1
+            return
+
+        self._pending[discord_id] = (
+            is_playing,
+            started_at,
+            asyncio.create_task(self._commit(discord_id, is_playing, started_at)),
+        )
+
+    async def flush(self):
+        """
+        Commits the pending changes without waiting for their debounce to
+        finish, e.g. so they aren't lost when the bot shuts down.
+        """
+        pending, self._pending = self._pending, {}
+        for _, _, task in pending.values():
+            task.cancel()
+        await asyncio.gather(
+            *(
+                self._apply(discord_id, is_playing, started_at)
+                for discord_id, (is_playing, started_at, _) in pending.items()
+            )
+        )
+
+    async def _commit(
+        self, discord_id: int, is_playing: bool, started_at: Optional[datetime]
+    ):
+        await asyncio.sleep(self.debounce_seconds)
+        del self._pending[discord_id]
+        await self._apply(discord_id, is_playing, started_at)
+
+    async def _apply(
+        self, discord_id: int, is_playing: bool, started_at: Optional[datetime]
+    ):
+        if is_playing:
+            self._playing.add(discord_id)
+        else:
+            self._playing.discard(discord_id)
+        self.counters["started" if is_playing else "stopped"] += 1
+        try:
+            await self.on_transition(discord_id, is_playing, started_at)
+        except Exception:
+            logger.error(
+                f"Could not record game session change for {discord_id}",
+                exc_info=True,
+            )
+
+    def log_counters(self):
+        logger.info(
+            "Presence updates: "
+            + ", ".join(f"{k}={v}" for k, v in sorted(self.counters.items()))
+        )
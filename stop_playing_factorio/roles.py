@@ -0,0 +1,247 @@
+"""
+The bot can be split across processes, each running one role, so that the
+gateway, the nudge schedule and the LLM calls don't share one event loop (and
+one GIL):
+
+- gateway: the Discord connection, tracking game sessions from presences and
+  replying to messages, but not sending nudges.
+- scheduler: a single process, which queues nudges in the database as they
+  fall due.
+- worker: any number of processes, which claim due nudges from the queue, and
+  generate and send them over Discord's HTTP API.
+
+The processes share the database. A worker's claim on a nudge is a lease,
+which it renews while it's working on the nudge. If the worker dies, the lease
+expires and another worker picks the nudge up. This makes delivery
+at-least-once: a worker that dies after sending a nudge but before recording
+it means the nudge is sent again.
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+import time
+from typing import Optional
+
+import pytz
+
+from stop_playing_factorio import metrics
+from stop_playing_factorio.db import connections
+from stop_playing_factorio.db.game_sessions import (
+    GameSession,
+    get_game_session,
+    get_game_sessions,
+)
+from stop_playing_factorio.db.nudge_queue import (
+    ClaimedNudge,
+    claim_nudges,
+    complete_nudge,
+    count_queued_nudges,
+    enqueue_nudge,
+    release_nudge,
+    renew_nudge_leases,
+)
+from stop_playing_factorio.db.writer import DatabaseWriter
+from stop_playing_factorio.game_watch_bot import (
+    ACTIVE_GAME_SESSIONS,
+    MAX_NUDGE_RETRY_DELAY,
+    NUDGE_RETRY_DELAY,
+    QUEUE_DEPTH,
+    GameWatchBot,
+)
+from stop_playing_factorio.metrics import timed_handler
+from stop_playing_factorio.nudge_scheduler import NudgeScheduler
+
+logger = logging.getLogger()
+
+ROLES = ("all", "gateway", "scheduler", "worker")
+
+# The scheduler reloads the game sessions this often, to pick up sessions
+# started and stopped by the gateway, and nudges sent by the workers.
+SCHEDULER_REFRESH_SECONDS = 10.0
+
+# Workers hold their claims on nudges for this long, renewing them every
+# third of it while they're still working on them.
+NUDGE_LEASE = timedelta(minutes=2)
+WORKER_POLL_SECONDS = 1.0
+
+NUDGES_QUEUED = metrics.counter(
+    "spfbot_nudges_queued_total", "Nudges queued for the workers by the scheduler."
+)
+
+
+class NudgeQueueScheduler:
+    """
+    The scheduler role. Keeps the game sessions in a `NudgeScheduler`, as the
+    bot does, but queues nudges for the workers when they're due rather than
+    sending them.
+
+    Nudges are only queued for a session if it hasn't been nudged since it
+    was loaded, so a nudge that's just been sent isn't queued again before the
+    sessions are reloaded.
+    """
+
+    def __init__(
+        self,
+        refresh_interval: float = SCHEDULER_REFRESH_SECONDS,
+        metrics_port: Optional[int] = None,
+    ):
+        self.refresh_interval = refresh_interval
+        self.metrics_port = metrics_port
+        self.db_writer = DatabaseWriter()
+        self.nudge_scheduler = NudgeScheduler()
+
+    async def run(self):
+        self.db_writer.start()
+        metrics_server = None
+        if self.metrics_port is not None:
+            QUEUE_DEPTH.set_function(self.queued_nudges, queue="nudge_queue")
+            ACTIVE_GAME_SESSIONS.set_function(lambda: len(self.nudge_scheduler))
+            metrics_server = await metrics.serve(port=self.metrics_port)
+        logger.info("Scheduling nudges...")
+        try:
+            while True:
+                with connections.reader() as con:
+                    self.nudge_scheduler.reset(get_game_sessions(con))
+                refresh_at = time.monotonic() + self.refresh_interval
+                while (remaining := refresh_at - time.monotonic()) > 0:
+                    try:
+                        await asyncio.wait_for(
+                            self.nudge_scheduler.wait_until_due(), remaining
+                        )
+                    except TimeoutError:
+                        break
+                    await self.queue_nudges_due()
+        finally:
+            if metrics_server:
+                await metrics_server.cleanup()
+            await self.db_writer.close()
+
+    @timed_handler("queue_nudges_due")
+    async def queue_nudges_due(self):
+        committed = [
+            await self.db_writer.submit(
+                enqueue_nudge,
+                game_session.discord_id,
+                game_session.next_nudge_due,
+                game_session.latest_nudge,
+            )
+            for game_session in self.nudge_scheduler.pop_due(datetime.now(tz=pytz.utc))
+        ]
+        # Failed writes are logged by the writer, and retried after the next
+        # refresh.
+        queued = await asyncio.gather(*committed, return_exceptions=True)
+        NUDGES_QUEUED.inc(sum(result is True for result in queued))
+
+    def queued_nudges(self) -> int:
+        with connections.reader() as con:
+            return count_queued_nudges(con)
+
+
+class NudgeWorker(GameWatchBot):
+    """
+    The worker role. Claims due nudges from the queue, up to `batch_size` at a
+    time, and sends them as the bot would. Workers log in to Discord's HTTP
+    API without connecting to the gateway, so they see no events, and any
+    number of them can run.
+    """
+
+    def __init__(
+        self,
+        game: str,
+        *args,
+        worker_id: Optional[str] = None,
+        batch_size: int = 8,
+        lease: timedelta = NUDGE_LEASE,
+        poll_interval: float = WORKER_POLL_SECONDS,
+        **kwargs,
+    ):
+        kwargs.setdefault("conversation_cache_size", 0)
+        super().__init__(game, *args, send_nudges=False, **kwargs)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+
+    async def run_worker(self, token: str):
+        async with self:
+            await self.login(token)
+            logger.info(f"Worker {self.worker_id} logged in as {self.user}")
+            lease_renewer = asyncio.create_task(self.renew_leases())
+            try:
+                await self.claim_loop()
+            finally:
+                lease_renewer.cancel()
+
+    async def claim_loop(self):
+        while not self.is_closed():
+            free = self.batch_size - len(self.nudges_in_flight)
+            claimed_nudges = []
+            if free > 0:
+                committed = await self.db_writer.submit(
+                    claim_nudges,
+                    self.worker_id,
+                    free,
+                    datetime.now(tz=pytz.utc) + self.lease,
+                )
+                try:
+                    claimed_nudges = await committed
+                except Exception:
+                    # Already logged by the writer; try again on the next poll.
+                    pass
+                for claimed in claimed_nudges:
+                    self.nudges_in_flight[claimed.discord_id] = asyncio.create_task(
+                        self.dispatch_claimed_nudge(claimed)
+                    )
+            await asyncio.sleep(self.poll_interval)
+
+    async def renew_leases(self):
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            if self.nudges_in_flight:
+                await self.db_writer.submit(
+                    renew_nudge_leases,
+                    self.worker_id,
+                    datetime.now(tz=pytz.utc) + self.lease,
+                )
+
+    @timed_handler("dispatch_claimed_nudge")
+    async def dispatch_claimed_nudge(self, claimed: ClaimedNudge):
+        try:
+            with connections.reader() as con:
+                game_session = get_game_session(con, claimed.discord_id)
+            if game_session is None:
+                # They've stopped playing since the nudge was queued.
+                await self.db_writer.submit(
+                    complete_nudge, claimed.discord_id, self.worker_id, None
+                )
+                return
+            async with self.nudge_slots:
+                logger.info(f"Nudge due for {claimed.discord_id}")
+                await self.send_nudge(game_session)
+        except Exception:
+            logger.error(
+                f"Could not send nudge to user {claimed.discord_id}", exc_info=True
+            )
+            retry_at = datetime.now(tz=pytz.utc) + min(
+                NUDGE_RETRY_DELAY * 2 ** (claimed.attempts - 1), MAX_NUDGE_RETRY_DELAY
+            )
+            await self.db_writer.submit(
+                release_nudge, claimed.discord_id, self.worker_id, retry_at
+            )
+        else:
+            # Retries are late by design, because of their backoff.
+            if game_session and claimed.attempts == 1:
+                self.nudge_lag.record(claimed.due, game_session.latest_nudge)
+        finally:
+            del self.nudges_in_flight[claimed.discord_id]
+
+    async def record_nudge_sent(self, game_session: GameSession):
+        await self.db_writer.submit(
+            complete_nudge,
+            game_session.discord_id,
+            self.worker_id,
+            game_session.latest_nudge,
+        )
@@ -0,0 +1,108 @@
+"""
+Checks the closed-form nudge times against the loops they replaced, which
+stepped forward one interval at a time until they passed the latest nudge.
+"""
+
+from datetime import UTC, datetime, timedelta
+
+from hypothesis import given, strategies as st
+
+from stop_playing_factorio.db.game_sessions import GameSession, _next_multiple_after
+
+TIME_ZONES = [None, "Europe/London", "America/New_York", "Asia/Kolkata", "Etc/GMT-14"]
+
+times = st.datetimes(
+    min_value=datetime(2020, 1, 1),
+    max_value=datetime(2030, 1, 1),
+    timezones=st.just(UTC),
+)
+steps = st.integers(min_value=1, max_value=240).map(
+    lambda minutes: timedelta(minutes=minutes)
+)
+offsets = st.timedeltas(min_value=timedelta(days=-3), max_value=timedelta(days=3))
+
+
+def loop_next_multiple_after(start: datetime, step: timedelta, after: datetime):
+    next_due = start
+    while next_due <= after:
+        next_due += step
+    return next_due
+
+
+def loop_next_duration_nudge_due(game_session: GameSession) -> datetime:
+    return loop_next_multiple_after(
+        game_session.started_at,
+        timedelta(minutes=game_session.duration_nudge_frequency),
+        game_session.latest_nudge or game_session.started_at,
+    )
+
+
+def loop_next_lateness_nudge_due(game_session: GameSession) -> datetime:
+    if not game_session.latest_nudge:
+        return game_session.lateness_threshold
+    return loop_next_multiple_after(
+        game_session.lateness_threshold,
+        timedelta(minutes=game_session.lateness_nudge_frequency),
+        game_session.latest_nudge,
+    )
+
+
+@st.composite
+def game_sessions(draw) -> GameSession:
+    started_at = draw(times)
+    nudged_after = draw(
+        st.none()
+        | st.timedeltas(min_value=timedelta(0), max_value=timedelta(days=2))
+        # Exactly on a duration nudge, as the nudges are sent on time.
+        | st.integers(min_value=0, max_value=48).map(lambda n: n * timedelta(hours=1))
+    )
+    return GameSession(
+        discord_id=1,
+        started_at=started_at,
+        duration_nudge_frequency=draw(st.sampled_from([15, 30, 60, 90])),
+        lateness_nudge_frequency=draw(st.sampled_from([10, 30, 45])),
+        latest_nudge=started_at + nudged_after if nudged_after is not None else None,
+        time_zone_str=draw(st.sampled_from(TIME_ZONES)),
+    )
+
+
+@given(times, steps, offsets)
+def test_next_multiple_after_matches_loop(start, step, offset):
+    after = start + offset
+    assert _next_multiple_after(start, step, after) == loop_next_multiple_after(
+        start, step, after
+    )
+
+
+@given(times, steps, st.integers(min_value=0, max_value=1000))
+def test_next_multiple_after_on_a_multiple(start, step, n):
+    after = start + n * step
+    assert _next_multiple_after(start, step, after) == start + (n + 1) * step
+    assert loop_next_multiple_after(start, step, after) == start + (n + 1) * step
+
+
+@given(game_sessions())
+def test_next_nudges_match_loops(game_session):
+    expected_duration = loop_next_duration_nudge_due(game_session)
+    expected_lateness = loop_next_lateness_nudge_due(game_session)
+    assert game_session.next_duration_nudge_due == expected_duration
+    assert game_session.next_lateness_nudge_due == expected_lateness
+    assert game_session.next_nudge_due == (
+        max(expected_duration, expected_lateness)
+        if abs(expected_duration - expected_lateness) < timedelta(minutes=15)
+        else min(expected_duration, expected_lateness)
+    )
+
+
+@given(game_sessions())
+def test_next_nudge_due_follows_latest_nudge(game_session):
+    # The cached value is recalculated when the session is nudged.
+    due = game_session.next_nudge_due
+    game_session.latest_nudge = due
+    assert game_session.next_nudge_due > due
+    assert game_session.next_duration_nudge_due == loop_next_duration_nudge_due(
+        game_session
+    )
+    assert game_session.next_lateness_nudge_due == loop_next_lateness_nudge_due(
+        game_session
+    )
@@ -0,0 +1,73 @@
+"""
+Checks that completing a nudge, which both removes it from the queue and
+records when the member was nudged, is all-or-nothing when it goes through
+the database writer.
+"""
+
+import asyncio
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+from stop_playing_factorio.db import connections, migrate
+from stop_playing_factorio.db.game_sessions import start_game_session
+from stop_playing_factorio.db.nudge_queue import (
+    claim_nudges,
+    complete_nudge,
+    enqueue_nudge,
+)
+from stop_playing_factorio.db.writer import DatabaseWriter
+
+
+@pytest.fixture
+def con(tmp_path):
+    connections.path = str(tmp_path / "spfbot.db")
+    con = connections.writer()
+    migrate(con)
+    yield con
+    connections.close()
+
+
+def queue_claimed_nudge(con, discord_id: int):
+    now = datetime.now(tz=UTC)
+    start_game_session(con, discord_id, now - timedelta(hours=1))
+    assert enqueue_nudge(con, discord_id, now, None)
+    assert claim_nudges(con, "worker", 1, now + timedelta(minutes=2))
+
+
+async def complete_through_writer(discord_id: int, latest_nudge: datetime):
+    db_writer = DatabaseWriter()
+    db_writer.start()
+    try:
+        committed = await db_writer.submit(
+            complete_nudge, discord_id, "worker", latest_nudge
+        )
+        await asyncio.gather(committed, return_exceptions=True)
+    finally:
+        await db_writer.close()
+
+
+def test_complete_nudge(con):
+    queue_claimed_nudge(con, 1)
+    sent_at = datetime.now(tz=UTC)
+    asyncio.run(complete_through_writer(1, sent_at))
+
+    assert con.execute("SELECT COUNT(*) FROM NudgeQueue;").fetchone() == (0,)
+    assert con.execute("SELECT latest_nudge FROM GameSessions;").fetchone() == (
+        sent_at,
+    )
+
+
+def test_failed_complete_nudge_stays_queued(con):
+    queue_claimed_nudge(con, 1)
+    con.execute(
+        """
+        CREATE TRIGGER FailNudgeUpdate BEFORE UPDATE OF latest_nudge ON GameSessions
+            BEGIN SELECT RAISE(ABORT, 'update failed'); END;
+        """
+    )
+    asyncio.run(complete_through_writer(1, datetime.now(tz=UTC)))
+
+    # The queue's DELETE ran first, but is rolled back with the failed UPDATE.
+    assert con.execute("SELECT discord_id FROM NudgeQueue;").fetchall() == [(1,)]
+    assert con.execute("SELECT latest_nudge FROM GameSessions;").fetchone() == (None,)
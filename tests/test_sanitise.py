@@ -0,0 +1,51 @@
+"""
+Checks the single-pass `Sanitiser` (and `StreamDesanitiser`) give the same
+output as the previous implementation, kept in the sanitise benchmark.
+"""
+
+from hypothesis import given, strategies as st
+
+from stop_playing_factorio.bench.sanitise import WORDS, legacy, single_pass
+from stop_playing_factorio.llm.sanitise import Sanitiser, StreamDesanitiser
+
+user_ids = st.sampled_from(["1", "42", "123456789012345678", "1234567890123456789"])
+tokens = st.one_of(
+    st.sampled_from(WORDS),
+    user_ids.map(lambda user_id: f"<@{user_id}>"),
+    # Near misses, which shouldn't be touched.
+    st.sampled_from(["<@", "<", ">", "@", "<@>", "<@abc>", "<@12", "<@!42>"]),
+)
+texts = st.lists(tokens, max_size=30).flatmap(
+    lambda parts: st.sampled_from(["", " "]).map(lambda sep: sep.join(parts))
+)
+messages = st.lists(
+    st.fixed_dictionaries(
+        {"role": st.sampled_from(["user", "assistant"]), "content": texts}
+    ),
+    max_size=10,
+)
+
+
+@given(texts, messages, texts)
+def test_single_pass_matches_legacy(instructions, messages, response):
+    # The LLM's response mentions the sanitised IDs.
+    output = Sanitiser().sanitise(response)
+    assert single_pass(instructions, messages, output) == legacy(
+        instructions, messages, output
+    )
+
+
+@given(texts, texts, st.lists(st.integers(min_value=0, max_value=200)))
+def test_stream_desanitiser_matches_desanitise(instructions, response, splits):
+    sanitiser = Sanitiser()
+    sanitiser.sanitise(instructions)
+    output = sanitiser.sanitise(response)
+
+    stream = StreamDesanitiser(sanitiser)
+    chunks = []
+    start = 0
+    for split in sorted(splits) + [len(output)]:
+        chunks.append(stream.feed(output[start:split]))
+        start = max(start, split)
+    chunks.append(stream.flush())
+    assert "".join(chunks) == sanitiser.desanitise(output)